@@ -1 +1 @@
-__all__ = ['sw']
+__all__ = ['sw', 'recorder', 'consensus', 'cooling']
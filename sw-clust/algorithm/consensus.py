@@ -0,0 +1,157 @@
+"""
+Consensus clustering over the samples of Swendsen-Wang Cuts.
+
+Usage:
+        from algorithm import consensus
+        co_association = consensus.SparseCoAssociation(graph_size, consensus.candidate_pairs(edges, neighbors))
+        sw.sample(..., intermediate_callback=co_association.callback)
+        clustering = co_association.consensus_clustering()
+
+    The co-association counts of how often two vertexes share a cluster are
+    updated incrementally from every sample. SparseCoAssociation keeps them
+    for the given candidate pairs only, e.g. the edges of the adjacency graph
+    and the k nearest neighbors of every vertex. DenseCoAssociation keeps all
+    pairs in a float32 matrix, optionally memory-mapped to a .npy file.
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from algorithm import sw
+
+
+def candidate_pairs(edges, neighbors=None):
+    """Distinct pairs (s, t) with s < t, as an array of shape (m, 2), from
+    the edges and from 'neighbors', where neighbors[v] are the indexes of
+    the nearest vertexes of v."""
+    pairs = [np.asarray(edges, dtype=np.int64).reshape(-1, 2)]
+    if neighbors is not None:
+        neighbors = np.asarray(neighbors, dtype=np.int64)
+        sources = np.repeat(np.arange(len(neighbors)), neighbors.shape[1])
+        pairs.append(np.stack([sources, neighbors.ravel()], axis=1))
+    pairs = np.concatenate(pairs)
+    pairs = np.sort(pairs, axis=1)
+    pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+    return np.unique(pairs, axis=0)
+
+
+class _CoAssociation(object):
+    """Accumulate the co-association of the samples of a chain, skipping the
+    first 'burn_in' iterations and taking every 'thin'-th iteration."""
+    def __init__(self, graph_size, thin=1, burn_in=0):
+        if thin < 1:
+            raise ValueError('thin shall be positive.')
+        self.graph_size = graph_size
+        self.thin = thin
+        self.burn_in = burn_in
+        self.num_samples = 0
+
+    def update(self, labels):
+        """Add the clustering given by its label array, regardless of thinning."""
+        self._add(np.asarray(labels))
+        self.num_samples += 1
+
+    def update_sample(self, sample):
+        """Add an SWSample of sw.iter_samples()."""
+        if self._is_kept(sample.iteration):
+            self.update(sample.labels)
+
+    def callback(self, clustering, context):
+        """intermediate_callback of sw.sample()."""
+        if self._is_kept(context.iteration_counter):
+            self.update(context.current_labels)
+
+    def update_chain(self, chain_reader, start=0, stop=None, step=1):
+        """Add the samples recorded by recorder.ChainRecorder."""
+        for (iteration, labels) in chain_reader.iter_labels(start, stop, step):
+            self.update(labels)
+
+    def _is_kept(self, iteration):
+        return iteration > self.burn_in and iteration % self.thin == 0
+
+    def consensus_clustering(self, threshold=0.5):
+        """Clustering in which vertexes are joined when they share a cluster
+        in at least 'threshold' of the samples (and transitively)."""
+        if self.num_samples == 0:
+            raise ValueError('No sample has been accumulated.')
+        (sources, targets) = self._frequent_pairs(threshold * self.num_samples)
+        graph = coo_matrix(
+            (np.ones(len(sources), dtype=np.int8), (sources, targets)),
+            shape=(self.graph_size, self.graph_size))
+        (unused, component_ids) = connected_components(graph, directed=False)
+        return sw.labels_to_clustering(component_ids)
+
+    def _add(self, labels):
+        raise NotImplementedError
+
+    def _frequent_pairs(self, min_count):
+        raise NotImplementedError
+
+
+class SparseCoAssociation(_CoAssociation):
+    """Co-association counts of the candidate 'pairs' only (see candidate_pairs()).
+    Each update costs one comparison per pair."""
+    def __init__(self, graph_size, pairs, thin=1, burn_in=0):
+        super(SparseCoAssociation, self).__init__(graph_size, thin, burn_in)
+        pairs = np.asarray(pairs, dtype=np.int64).reshape(-1, 2)
+        self.sources = pairs[:, 0]
+        self.targets = pairs[:, 1]
+        self.counts = np.zeros(len(pairs), dtype=np.float64)
+
+    def _add(self, labels):
+        self.counts += labels[self.sources] == labels[self.targets]
+
+    def frequencies(self):
+        """Fraction of the samples in which each pair shares a cluster."""
+        return self.counts / max(self.num_samples, 1)
+
+    def _frequent_pairs(self, min_count):
+        frequent = self.counts >= min_count
+        return (self.sources[frequent], self.targets[frequent])
+
+
+class DenseCoAssociation(_CoAssociation):
+    """Co-association counts of all pairs in a float32 matrix, memory-mapped
+    to 'filename' (.npy) if given. Each update costs the sum of squared
+    cluster sizes."""
+    def __init__(self, graph_size, filename=None, thin=1, burn_in=0, block_size=4096):
+        super(DenseCoAssociation, self).__init__(graph_size, thin, burn_in)
+        if filename is not None:
+            self.counts = np.lib.format.open_memmap(filename, mode='w+', dtype=np.float32, shape=(graph_size, graph_size))
+        else:
+            self.counts = np.zeros((graph_size, graph_size), dtype=np.float32)
+        self._block_size = block_size
+
+    def _add(self, labels):
+        order = np.argsort(labels, kind='stable')
+        (unused, starts, sizes) = np.unique(labels[order], return_index=True, return_counts=True)
+        # Singletons only share a cluster with themselves.
+        singletons = order[starts[sizes == 1]]
+        self.counts[singletons, singletons] += 1
+        for (start, size) in zip(starts[sizes > 1].tolist(), sizes[sizes > 1].tolist()):
+            members = np.sort(order[start:start + size])
+            self.counts[np.ix_(members, members)] += 1
+
+    def frequencies(self):
+        """Fraction of the samples in which each pair shares a cluster."""
+        return self.counts / np.float32(max(self.num_samples, 1))
+
+    def flush(self):
+        if isinstance(self.counts, np.memmap):
+            self.counts.flush()
+
+    def _frequent_pairs(self, min_count):
+        sources = []
+        targets = []
+        # Scan the upper triangle by blocks of rows.
+        for start in range(0, self.graph_size, self._block_size):
+            block = self.counts[start:start + self._block_size]
+            (rows, columns) = np.nonzero(block >= min_count)
+            rows += start
+            upper = rows < columns
+            sources.append(rows[upper])
+            targets.append(columns[upper])
+        if len(sources) == 0:
+            return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+        return (np.concatenate(sources), np.concatenate(targets))
@@ -0,0 +1,266 @@
+"""
+Cooling schedules of Swendsen-Wang Cuts annealing.
+
+Usage:
+        from algorithm import cooling
+        schedule = cooling.make_schedule('lam', start=1000)
+        sw.sample(..., model=model, cooling_schedule=schedule)
+
+    The sampler sets context.temperature to schedule.temperature before every
+    iteration, and calls schedule.update(context, energy) after it, where
+    energy is -log target * temperature of the current state. Models read
+    the temperature from context.temperature (see
+    sw.ClusterEnergyModel.temperature()).
+
+    The adaptive schedules lower the temperature once per stage of 'period'
+    iterations, by an amount which depends on the fraction of flips which
+    changed the clustering in the stage (context.stats) and, for 'variance'
+    and 'lam', on the variance of the energy in the stage. They leave the hot
+    regime, where nearly every flip is accepted, within a few stages.
+"""
+
+import math
+
+
+class LinearCooling(object):
+    """temperature = start - floor(iteration/period) * step, and 'minimum'
+    once it is not positive. This is the fixed schedule of the models."""
+    uses_energy = False
+
+    def __init__(self, start=1000.0, period=5, step=5.0, minimum=0.1):
+        super(LinearCooling, self).__init__()
+        if period < 1:
+            raise ValueError('period shall be a positive number of iterations.')
+        self.start = start
+        self.period = period
+        self.step = step
+        self.minimum = minimum
+        self.temperature = self._temperature_at(1)
+
+    @property
+    def frozen(self):
+        return self.temperature <= self.minimum
+
+    def initialize(self, context):
+        self.temperature = self._temperature_at(context.iteration_counter + 1)
+
+    def update(self, context, energy):
+        self.temperature = self._temperature_at(context.iteration_counter + 1)
+
+    def _temperature_at(self, iteration_counter):
+        temperature = self.start - int(iteration_counter/self.period)*self.step
+        if temperature <= 0:
+            temperature = self.minimum
+        return temperature
+
+    def get_state(self):
+        return {}
+
+    def set_state(self, state):
+        pass
+
+
+class _AdaptiveCooling(object):
+    """Collect the acceptance rate and the energy statistics of every stage
+    of 'period' iterations, and let _next_temperature() cool at its end."""
+    uses_energy = False
+
+    def __init__(self, start, period, minimum):
+        super(_AdaptiveCooling, self).__init__()
+        if start <= 0 or minimum <= 0:
+            raise ValueError('Temperatures shall be positive.')
+        if period < 1:
+            raise ValueError('period shall be a positive number of iterations.')
+        self.period = period
+        self.minimum = minimum
+        self.temperature = float(start)
+        self.num_stages = 0
+        self._stage = _StageStatistics()
+        self._last_flips = 0
+        self._last_accepted = 0
+
+    @property
+    def frozen(self):
+        return self.temperature <= self.minimum
+
+    def initialize(self, context):
+        # The counters of context.stats start over when a chain is resumed.
+        self._last_flips = context.stats.num_flips
+        self._last_accepted = _num_accepted(context.stats)
+
+    def update(self, context, energy):
+        stats = context.stats
+        self._stage.add(stats.num_flips - self._last_flips, _num_accepted(stats) - self._last_accepted, energy)
+        self._last_flips = stats.num_flips
+        self._last_accepted = _num_accepted(stats)
+        if self._stage.num_iterations < self.period:
+            return
+
+        if not self.frozen:
+            temperature = self._next_temperature(self._stage)
+            self.temperature = max(min(temperature, self.temperature), self.minimum)
+        self.num_stages += 1
+        self._stage = _StageStatistics()
+
+    def _next_temperature(self, stage):
+        raise NotImplementedError
+
+    def get_state(self):
+        return {
+            'temperature': self.temperature,
+            'num_stages': self.num_stages,
+            'stage': self._stage.get_state()}
+
+    def set_state(self, state):
+        self.temperature = state['temperature']
+        self.num_stages = state['num_stages']
+        self._stage.set_state(state['stage'])
+
+
+class AdaptiveGeometricCooling(_AdaptiveCooling):
+    """temperature *= factor at the end of every stage, where the factor is
+    'fast_factor' while more than 'high_acceptance' of the flips are
+    accepted, 'slow_factor' when less than 'low_acceptance' are, and
+    'factor' in between."""
+    def __init__(self, start=1000.0, period=10, factor=0.9, fast_factor=0.5, slow_factor=0.98,
+                 high_acceptance=0.8, low_acceptance=0.2, minimum=0.1):
+        super(AdaptiveGeometricCooling, self).__init__(start, period, minimum)
+        if not (0 < fast_factor <= factor <= slow_factor < 1):
+            raise ValueError('Cooling factors shall satisfy 0 < fast_factor <= factor <= slow_factor < 1.')
+        self.factor = factor
+        self.fast_factor = fast_factor
+        self.slow_factor = slow_factor
+        self.high_acceptance = high_acceptance
+        self.low_acceptance = low_acceptance
+
+    def _next_temperature(self, stage):
+        acceptance_rate = stage.acceptance_rate
+        if acceptance_rate > self.high_acceptance:
+            return self.temperature * self.fast_factor
+        if acceptance_rate < self.low_acceptance:
+            return self.temperature * self.slow_factor
+        return self.temperature * self.factor
+
+
+class VarianceCooling(_AdaptiveCooling):
+    """Cooling of Aarts and van Laarhoven:
+        temperature /= 1 + temperature * log(1 + delta) / (3 * std(energy))
+    The larger the energy fluctuates in a stage, the slower it cools; a
+    stage without any change of the energy cools by 'max_factor'."""
+    uses_energy = True
+
+    def __init__(self, start=1000.0, period=10, delta=0.1, max_factor=0.5, minimum=0.1):
+        super(VarianceCooling, self).__init__(start, period, minimum)
+        self.delta = delta
+        self.max_factor = max_factor
+
+    def _next_temperature(self, stage):
+        std = stage.energy_std
+        if std <= 0:
+            return self.temperature * self.max_factor
+        temperature = self.temperature / (1 + self.temperature * math.log1p(self.delta) / (3 * std))
+        return max(temperature, self.temperature * self.max_factor)
+
+
+class LamCooling(_AdaptiveCooling):
+    """Cooling of Lam and Delosme, in inverse temperature s = 1/temperature:
+        s += quality / std * 1 / (s * std)**2 * 4 * rho * (1 - rho)**2 / (2 - rho)**2
+    where std is the standard deviation of the energy and rho the acceptance
+    rate, both smoothed over stages by 'smoothing'. The step is largest when
+    rho is near 0.44, and the temperature drops by at most 'max_factor' per
+    stage. A smaller 'quality' cools more slowly."""
+    uses_energy = True
+
+    def __init__(self, start=1000.0, period=10, quality=1.0, smoothing=0.5, max_factor=0.5, minimum=0.1):
+        super(LamCooling, self).__init__(start, period, minimum)
+        if not (0 <= smoothing < 1):
+            raise ValueError('smoothing shall be in [0, 1).')
+        self.quality = quality
+        self.smoothing = smoothing
+        self.max_factor = max_factor
+        self._std = None
+        self._acceptance_rate = None
+
+    def _next_temperature(self, stage):
+        if self._std is None:
+            (self._std, self._acceptance_rate) = (stage.energy_std, stage.acceptance_rate)
+        else:
+            self._std = self.smoothing * self._std + (1 - self.smoothing) * stage.energy_std
+            self._acceptance_rate = self.smoothing * self._acceptance_rate + (1 - self.smoothing) * stage.acceptance_rate
+        if self._std <= 0:
+            return self.temperature * self.max_factor
+
+        # rho of exactly 0 or 1 would stall the schedule.
+        rho = min(max(self._acceptance_rate, 0.01), 0.99)
+        s = 1.0 / self.temperature
+        step = self.quality / self._std / (s * self._std)**2 * 4 * rho * (1 - rho)**2 / (2 - rho)**2
+        return max(1.0 / (s + step), self.temperature * self.max_factor)
+
+    def get_state(self):
+        state = super(LamCooling, self).get_state()
+        state['std'] = self._std
+        state['acceptance_rate'] = self._acceptance_rate
+        return state
+
+    def set_state(self, state):
+        super(LamCooling, self).set_state(state)
+        self._std = state['std']
+        self._acceptance_rate = state['acceptance_rate']
+
+
+class _StageStatistics(object):
+    """Flip counts and the running mean and variance of the energy
+    (by Welford's method) over the iterations of a stage."""
+    def __init__(self):
+        self.num_iterations = 0
+        self.num_flips = 0
+        self.num_accepted = 0
+        self._num_energies = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, num_flips, num_accepted, energy):
+        self.num_iterations += 1
+        self.num_flips += num_flips
+        self.num_accepted += num_accepted
+        if energy is not None:
+            self._num_energies += 1
+            difference = energy - self._mean
+            self._mean += difference / self._num_energies
+            self._m2 += difference * (energy - self._mean)
+
+    @property
+    def acceptance_rate(self):
+        if self.num_flips == 0:
+            return 0.0
+        return self.num_accepted / float(self.num_flips)
+
+    @property
+    def energy_std(self):
+        if self._num_energies < 2:
+            return 0.0
+        return math.sqrt(self._m2 / (self._num_energies - 1))
+
+    def get_state(self):
+        return [self.num_iterations, self.num_flips, self.num_accepted, self._num_energies, self._mean, self._m2]
+
+    def set_state(self, state):
+        (self.num_iterations, self.num_flips, self.num_accepted, self._num_energies, self._mean, self._m2) = state
+
+
+def _num_accepted(stats):
+    return stats.num_moves_to_existing + stats.num_moves_to_new
+
+
+SCHEDULES = {
+    'linear': LinearCooling,
+    'geometric': AdaptiveGeometricCooling,
+    'variance': VarianceCooling,
+    'lam': LamCooling}
+
+
+def make_schedule(name, **kwargs):
+    """Cooling schedule by its name in SCHEDULES, e.g. make_schedule('lam', start=1000)."""
+    if name not in SCHEDULES:
+        raise ValueError('Unknown cooling schedule: {0}'.format(name))
+    return SCHEDULES[name](**kwargs)
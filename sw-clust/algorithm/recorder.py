@@ -0,0 +1,225 @@
+"""
+On-disk history of Swendsen-Wang Cuts chains.
+
+Usage:
+        from algorithm import recorder
+        with recorder.ChainRecorder('chain', graph_size, thin=100) as chain_recorder:
+            sw.sample(..., intermediate_callback=chain_recorder.callback)
+
+        chain = recorder.ChainReader('chain')
+        for (iteration, labels) in chain.iter_labels():
+            ...
+
+    Thinned label arrays are appended to preallocated memory-mapped .npy
+    segments, so the history of a long run does not stay in memory.
+"""
+
+import json
+import math
+import os
+
+import numpy as np
+
+from algorithm import sw
+
+
+_INDEX_FILENAME = 'index.json'
+
+# Fields of the record of every sample.
+RECORD_DTYPE = np.dtype([('iteration', np.int64), ('energy', np.float64), ('log_target', np.float64)])
+
+
+def _label_dtype(graph_size):
+    """Labels are below the size of the graph."""
+    return np.int16 if graph_size <= np.iinfo(np.int16).max else np.int32
+
+
+def _segment_filenames(directory, segment):
+    return (os.path.join(directory, 'labels_{0:05d}.npy'.format(segment)),
+            os.path.join(directory, 'records_{0:05d}.npy'.format(segment)))
+
+
+def _read_index(directory):
+    with open(os.path.join(directory, _INDEX_FILENAME)) as f:
+        return json.load(f)
+
+
+class ChainRecorder(object):
+    """Append samples of a chain to 'directory'. Every segment holds
+    'segment_size' samples, as labels_<k>.npy of shape
+    (segment_size, graph_size) and records_<k>.npy of RECORD_DTYPE. A new
+    segment is allocated when the last one is full. index.json tells the
+    number of samples, and is replaced atomically on flush().
+
+    If 'resume' is True, the samples in 'directory' are kept and new ones
+    appended. Recording an iteration not after the last recorded one first
+    drops the recorded samples from that iteration on, so a chain resumed
+    from a checkpoint does not record an iteration twice."""
+    def __init__(self, directory, graph_size, thin=1, segment_size=1024, energy_func=None, resume=False):
+        super(ChainRecorder, self).__init__()
+        if thin < 1 or segment_size < 1:
+            raise ValueError('thin and segment_size shall be positive.')
+        self.directory = directory
+        self.graph_size = graph_size
+        self.thin = thin
+        self._energy_func = energy_func
+        self._labels = []
+        self._records = []
+        self._num_samples = 0
+
+        if resume and os.path.exists(os.path.join(directory, _INDEX_FILENAME)):
+            index = _read_index(directory)
+            if index['graph_size'] != graph_size:
+                raise ValueError('The recorded chain does not match the size of the graph.')
+            self._segment_size = index['segment_size']
+            self._num_samples = index['num_samples']
+            for segment in range(0, index['num_segments']):
+                (labels_filename, records_filename) = _segment_filenames(directory, segment)
+                self._labels.append(np.load(labels_filename, mmap_mode='r+'))
+                self._records.append(np.load(records_filename, mmap_mode='r+'))
+        else:
+            os.makedirs(directory, exist_ok=True)
+            self._segment_size = segment_size
+            self._write_index()
+
+    def __len__(self):
+        return self._num_samples
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, labels, iteration, energy=math.nan, log_target=math.nan):
+        """Append the label array of a sample, regardless of thinning."""
+        if self._num_samples > 0 and iteration <= self._last_iteration():
+            self._rewind(iteration)
+        (segment, offset) = divmod(self._num_samples, self._segment_size)
+        if segment == len(self._labels):
+            self._allocate_segment()
+        self._labels[segment][offset] = labels
+        self._records[segment][offset] = (iteration, energy, log_target)
+        self._num_samples += 1
+
+    def record_sample(self, sample):
+        """Append an SWSample of sw.iter_samples() every 'thin' iterations,
+        with its log target and the energy by energy_func if any."""
+        if sample.iteration % self.thin != 0:
+            return
+        energy = math.nan
+        if self._energy_func is not None:
+            energy = float(self._energy_func(sample.clustering()))
+        log_target = sample.log_target
+        self.record(sample.labels, sample.iteration, energy, math.nan if log_target is None else log_target)
+
+    def callback(self, clustering, context):
+        """intermediate_callback of sw.sample() recording every 'thin'
+        iterations, with the energy by energy_func if any."""
+        if context.iteration_counter % self.thin != 0:
+            return
+        energy = math.nan
+        if self._energy_func is not None:
+            energy = float(self._energy_func(clustering))
+        self.record(context.current_labels, context.iteration_counter, energy)
+
+    def flush(self):
+        for array in self._labels + self._records:
+            array.flush()
+        self._write_index()
+
+    def close(self):
+        self.flush()
+        self._labels = []
+        self._records = []
+
+    def _last_iteration(self):
+        (segment, offset) = divmod(self._num_samples - 1, self._segment_size)
+        return int(self._records[segment][offset]['iteration'])
+
+    def _rewind(self, iteration):
+        """Drop the samples from 'iteration' on."""
+        iterations = np.concatenate([records['iteration'] for records in self._records])[0:self._num_samples]
+        self._num_samples = int(np.searchsorted(iterations, iteration, side='left'))
+
+    def _allocate_segment(self):
+        (labels_filename, records_filename) = _segment_filenames(self.directory, len(self._labels))
+        self._labels.append(np.lib.format.open_memmap(
+            labels_filename, mode='w+', dtype=_label_dtype(self.graph_size), shape=(self._segment_size, self.graph_size)))
+        self._records.append(np.lib.format.open_memmap(
+            records_filename, mode='w+', dtype=RECORD_DTYPE, shape=(self._segment_size,)))
+
+    def _write_index(self):
+        index = {
+            'graph_size': self.graph_size,
+            'thin': self.thin,
+            'segment_size': self._segment_size,
+            'num_segments': len(self._labels),
+            'num_samples': self._num_samples}
+        filename = os.path.join(self.directory, _INDEX_FILENAME)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump(index, f)
+        os.replace(filename + '.tmp', filename)
+
+
+class ChainReader(object):
+    """Read a chain written by ChainRecorder. Label arrays are memory-mapped
+    read-only and loaded on access."""
+    def __init__(self, directory):
+        super(ChainReader, self).__init__()
+        index = _read_index(directory)
+        self.graph_size = index['graph_size']
+        self.thin = index['thin']
+        self._segment_size = index['segment_size']
+        self._num_samples = index['num_samples']
+        self._labels = []
+        records = []
+        for segment in range(0, index['num_segments']):
+            (labels_filename, records_filename) = _segment_filenames(directory, segment)
+            self._labels.append(np.load(labels_filename, mmap_mode='r'))
+            records.append(np.load(records_filename, mmap_mode='r'))
+        if len(records) > 0:
+            self._records = np.concatenate(records)[0:self._num_samples]
+        else:
+            self._records = np.empty(0, dtype=RECORD_DTYPE)
+
+    def __len__(self):
+        return self._num_samples
+
+    @property
+    def iterations(self):
+        return self._records['iteration']
+
+    @property
+    def energies(self):
+        return self._records['energy']
+
+    @property
+    def log_targets(self):
+        return self._records['log_target']
+
+    def labels(self, index):
+        """Label array of the index-th recorded sample."""
+        if index < 0:
+            index += self._num_samples
+        if not (0 <= index < self._num_samples):
+            raise IndexError('Sample index out of range.')
+        (segment, offset) = divmod(index, self._segment_size)
+        return self._labels[segment][offset]
+
+    def clustering(self, index):
+        """Clustering of the index-th recorded sample, as a list of sets."""
+        return sw.labels_to_clustering(self.labels(index))
+
+    def iter_labels(self, start=0, stop=None, step=1):
+        """Generate (iteration, label array) of the recorded samples."""
+        for index in range(*slice(start, stop, step).indices(self._num_samples)):
+            yield (int(self._records[index]['iteration']), self.labels(index))
+
+    def label_matrix(self, start=0, stop=None, step=1):
+        """Label arrays of the recorded samples, loaded as one array."""
+        indexes = range(*slice(start, stop, step).indices(self._num_samples))
+        matrix = np.empty((len(indexes), self.graph_size), dtype=_label_dtype(self.graph_size))
+        for (row, index) in enumerate(indexes):
+            matrix[row] = self.labels(index)
+        return matrix
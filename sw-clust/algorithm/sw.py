@@ -5,18 +5,38 @@ Usage:
         import sw
         labeling = sw.sample(...)
 
-    See sample() function for details.
+    See sample() function for details. Samples can also be consumed one by
+    one from the generator iter_samples().
+
+    Several independent chains can be run in parallel by sample_chains(),
+    and replicas at a ladder of temperatures by sample_replica_exchange().
 """
 
+from collections import Counter
 from collections import defaultdict
 from collections import deque
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 import copy
-import random
+import itertools
+import json
+import logging
+import math
+import multiprocessing
+import os
+import queue
+import time
 
 import mpmath
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+_logger = logging.getLogger(__name__)
 
 
-def sample(graph_size, edges, edge_prob_func, target_eval_func, intermediate_callback=None, initial_clustering=None, monitor_statistics=None):
+def sample(graph_size, edges, edge_prob_func, target_eval_func, intermediate_callback=None, initial_clustering=None, monitor_statistics=None, edge_probs_func=None, seed=None, log_target=False, log_edge_off_func=None, model=None, checkpoint_file=None, checkpoint_interval=100, resume=False, stop_criteria=None, sweep=None, static_edge_probs=False, stats_file=None, stats_interval=100, executor=None, max_workers=None, cooling_schedule=None, split_merge_ratio=0.0, split_merge_distance_func=None):
     """Generating fair samples by Swendsen-Wang Cuts.
 Parameters:
 - graph_size:
@@ -32,6 +52,8 @@ Parameters:
     turning on edges (s, t). This function shall be in the
     following form:
         edge_func(s, t, context)
+    Static probabilities may instead be given as an array aligned with
+    'edges' (see static_edge_probs).
 
 - target_eval_func:
     the callback function which evaluates the probability of a
@@ -51,249 +73,1512 @@ Parameters:
 
 - monitor_statistics (optional):
     the statistics to diagnose convergence. The process converges when
-    this designated statistics remain unchanged for 500 iterations.
-    The process will not stop if this parameter is not provided.
+    this designated statistics remain unchanged for 1000 iterations.
+    The process will not stop if neither this parameter nor stop_criteria
+    is provided. 'clustering' holds the live member sets of the sampler
+    and shall not be kept.
         monitor_statistics(clustering)
+
+- edge_probs_func (optional):
+    the vectorized alternative to edge_prob_func. It returns the
+    probabilities of turning on all edges at once, as a NumPy array
+    aligned with 'edges'. When provided, edge states are drawn in one
+    vectorized step; edge_prob_func is not used and may be None.
+        edge_probs_func(context)
+
+- seed (optional):
+    seed of the random number generator used by the sampler.
+
+- log_target (optional):
+    if True, target_eval_func returns the natural logarithm of the
+    target probability, and candidate posteriors are normalized in
+    float64 log space instead of with mpmath.
+
+- log_edge_off_func (optional):
+    used when log_target is True. It returns log(1 - q) for edge (s, t),
+    where q is the probability of turning the edge on. If not provided,
+    it is derived from the edge probability.
+        log_edge_off_func(s, t, context)
+
+- model (optional):
+    an object implementing the IncrementalModel protocol. When it
+    provides delta_log_target, candidates are scored by the change of
+    the log target caused by each move, and target_eval_func is not used.
+    All candidates of a flip are scored by one call of its
+    batch_target_eval, if any. Without delta_log_target, the full
+    evaluation by target_eval_func is kept.
+
+- checkpoint_file (optional):
+    the .npz file to which the sampler state (labels, iteration counter,
+    random state and stop criteria) is saved every
+    'checkpoint_interval' iterations and when sampling ends.
+
+- resume (optional):
+    if True and checkpoint_file exists, sampling continues from the
+    checkpoint instead of initial_clustering and seed. With deterministic
+    callbacks, the resumed chain is identical to an uninterrupted one.
+    A checkpoint made with other stop criteria or another cooling
+    schedule raises ValueError.
+
+- stop_criteria (optional):
+    a list of additional stop criteria, e.g. StationaryCriterion,
+    TimeBudget or IterationBudget. The process stops as soon as any
+    criterion is met.
+
+- sweep (optional):
+    by default, one randomly selected connected component is flipped per
+    iteration. If a fraction in (0, 1] is given, that fraction of the
+    connected components (at least one) is flipped per iteration in a
+    random order, each against the state updated by the previous flips,
+    sharing one draw of edge states.
+
+- static_edge_probs (optional):
+    declares that edge probabilities do not change during sampling. Then
+    edge_prob_func (and log_edge_off_func) is evaluated once per edge
+    before sampling, and the tables of q and log(1 - q) are indexed in
+    every iteration by the vectorized path. This is implied when
+    edge_prob_func is an array, and ignored when edge_prob_func is None
+    and edge_probs_func is provided.
+
+- stats_file (optional):
+    a file to which a JSON line of the sampler statistics (see SWStats)
+    is appended every 'stats_interval' iterations and when sampling ends.
+    The statistics are also available as context.stats in callbacks.
+
+- executor (optional):
+    'thread' or 'process'. When candidates are evaluated by
+    target_eval_func, the candidates of a flip are evaluated by a pool of
+    'max_workers' workers, which receive the label array and the move
+    instead of the clustering. With 'process', target_eval_func shall be
+    picklable; it is sent once to every worker.
+
+- cooling_schedule (optional):
+    a schedule of algorithm.cooling, e.g. cooling.make_schedule('lam').
+    Before every iteration context.temperature is set to its temperature,
+    which ClusterEnergyModel uses instead of temperature(context). After
+    every iteration it is updated with the acceptance statistics and the
+    energy, -log target * temperature, so target_eval_func shall read the
+    temperature from the context. Its state is saved in checkpoints.
+
+- split_merge_ratio (optional):
+    the fraction of iterations which make a data-driven split or merge
+    proposal, accepted by Metropolis-Hastings, instead of flipping
+    components. A seed vertex i is drawn uniformly. A merge joins the
+    cluster of i with the cluster of a vertex j drawn outside of it with
+    probability proportional to exp(-distance(i, j)/scale). A split draws
+    j from the cluster of i proportional to distance(i, j), and assigns
+    every other member to the side of the seed it is closer to, by the
+    same exp(-distance/scale) weights. The scale is the median distance
+    over the edges.
+
+- split_merge_distance_func (optional):
+    required with split_merge_ratio. It returns the symmetric distances
+    of vertex v to an array of vertexes, e.g. the symmetric KL divergence.
+        split_merge_distance_func(v, vertices)
 """
-    sw = _SWCuts()
+    sw = _SWCuts(seed)
     return sw.sample(
         _AdjacencyGraph(graph_size, edges),
         edge_prob_func,
         target_eval_func,
         intermediate_callback=intermediate_callback,
         initial_clustering=initial_clustering,
-        monitor_statistics_func=monitor_statistics)
+        monitor_statistics_func=monitor_statistics,
+        edge_probs_func=edge_probs_func,
+        log_target=log_target,
+        log_edge_off_func=log_edge_off_func,
+        model=model,
+        checkpoint_file=checkpoint_file,
+        checkpoint_interval=checkpoint_interval,
+        resume=resume,
+        stop_criteria=stop_criteria,
+        sweep=sweep,
+        static_edge_probs=static_edge_probs,
+        stats_file=stats_file,
+        stats_interval=stats_interval,
+        executor=executor,
+        max_workers=max_workers,
+        cooling_schedule=cooling_schedule,
+        split_merge_ratio=split_merge_ratio,
+        split_merge_distance_func=split_merge_distance_func)
+
+
+def iter_samples(graph_size, edges, edge_prob_func, target_eval_func, seed=None, **kwargs):
+    """Generate the samples of Swendsen-Wang Cuts one iteration at a time.
+Parameters are the same as sample(), except intermediate_callback.
+Every iteration yields an SWSample, which refers to the state of the
+sampler without copying it. Stopping the iteration early ends the sampling
+as if it had converged, e.g. the final checkpoint is written.
+    for s in sw.iter_samples(...):
+        if s.iteration % 100 == 0:
+            kept.append(s.copy())
+"""
+    if 'monitor_statistics' in kwargs:
+        kwargs['monitor_statistics_func'] = kwargs.pop('monitor_statistics')
+    sw = _SWCuts(seed)
+    return sw.iter_samples(_AdjacencyGraph(graph_size, edges), edge_prob_func, target_eval_func, **kwargs)
+
+
+def sample_chains(n_chains, graph_size, edges, edge_prob_func, target_eval_func, monitor_statistics, initial_clustering=None, seed=None, r_hat_threshold=1.05, min_samples=100, report_interval=10, max_workers=None, **kwargs):
+    """Run independent Swendsen-Wang Cuts chains in worker processes.
+Every chain gets its own random stream spawned from 'seed'. All chains
+stop as soon as the Gelman-Rubin R-hat of the monitored statistics (e.g.
+energy) falls below 'r_hat_threshold', or when each chain has converged
+by itself as in sample().
+
+Parameters are the same as sample(), plus:
+- n_chains:
+    number of chains.
+
+- monitor_statistics:
+    required. The statistics of which R-hat is computed. Lower values
+    are better, and the chain ending with the lowest one is the best.
+
+- r_hat_threshold (optional):
+    chains are stopped once R-hat is below this value.
+
+- min_samples (optional):
+    least number of statistics per chain before R-hat is computed.
+    The second half of the common length of all chains is used, in
+    blocks of 'report_interval' statistics.
+
+- report_interval (optional):
+    number of iterations between two reports from a chain.
+    The statistics are only kept as sums per block of this size.
+
+- max_workers (optional):
+    number of worker processes, one per chain by default.
+
+All callbacks and the model shall be picklable. intermediate_callback
+is not supported.
+
+Returns an SWChainsResult.
+"""
+    seeds = np.random.SeedSequence(seed).spawn(n_chains)
+    if max_workers is None:
+        max_workers = n_chains
+
+    traces = _ChainTraces(n_chains, report_interval)
+    with multiprocessing.Manager() as manager:
+        stop_event = manager.Event()
+        report_queue = manager.Queue()
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(
+                _run_chain, chain_id, seeds[chain_id], graph_size, edges, edge_prob_func,
+                target_eval_func, monitor_statistics, initial_clustering, stop_event,
+                report_queue, report_interval, kwargs) for chain_id in range(0, n_chains)]
+
+            while not all(f.done() for f in futures) or not report_queue.empty():
+                try:
+                    (chain_id, values) = report_queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                traces.add(chain_id, values)
+                r_hat = traces.r_hat(min_samples)
+                if r_hat < r_hat_threshold and not stop_event.is_set():
+                    stop_event.set()
+            results = [f.result() for f in futures]
+
+    clusterings = [clustering for (clustering, statistics) in results]
+    final_statistics = [statistics for (clustering, statistics) in results]
+    best_chain = int(np.argmin(final_statistics))
+    return SWChainsResult(
+        clusterings, clusterings[best_chain], final_statistics[best_chain], traces.r_hat(min_samples), list(traces.lengths))
+
+
+# Result of sample_chains().
+# - clusterings: final clustering of every chain.
+# - best_clustering / best_statistics: the chain ending with the lowest statistics.
+# - r_hat: Gelman-Rubin R-hat when the chains stopped.
+# - iterations: number of iterations run by every chain.
+SWChainsResult = namedtuple('SWChainsResult', ['clusterings', 'best_clustering', 'best_statistics', 'r_hat', 'iterations'])
+
+
+def gelman_rubin(traces):
+    """Gelman-Rubin potential scale reduction factor (R-hat) of
+    several chains, given as a 2D array (one row per chain)."""
+    traces = np.asarray(traces, dtype=np.float64)
+    (num_chains, length) = traces.shape
+    if num_chains < 2 or length < 2:
+        return math.inf
+    return _potential_scale_reduction(np.mean(traces, axis=1), np.var(traces, axis=1, ddof=1), length)
+
+
+def _potential_scale_reduction(means, variances, length):
+    """R-hat from the mean and the variance of every chain over 'length' values."""
+    within = np.mean(variances)
+    between = length * np.var(means, ddof=1)
+    if within == 0:
+        return 1.0 if between == 0 else math.inf
+    pooled = (length - 1) / length * within + between / length
+    return math.sqrt(pooled / within)
+
+
+class _ChainTraces(object):
+    """The statistics reported by the chains of sample_chains(), kept as
+    cumulative sums and sums of squares at every 'block_size' values.
+    R-hat over the second half of the common complete blocks then costs
+    O(chains), and is only recomputed when that number of blocks grows."""
+    def __init__(self, n_chains, block_size):
+        self._block_size = block_size
+        self.lengths = [0] * n_chains
+        # Values are shifted by the first one to keep the sums accurate.
+        self._offset = None
+        self._sums = [[0.0] for i in range(0, n_chains)]
+        self._squares = [[0.0] for i in range(0, n_chains)]
+        self._partial = [(0.0, 0.0) for i in range(0, n_chains)]
+        self._num_blocks = 0
+        self._r_hat = math.inf
+
+    def add(self, chain_id, values):
+        if self._offset is None and len(values) > 0:
+            self._offset = float(values[0])
+        (total, squares) = self._partial[chain_id]
+        for value in values:
+            value = float(value) - self._offset
+            total += value
+            squares += value * value
+            self.lengths[chain_id] += 1
+            if self.lengths[chain_id] % self._block_size == 0:
+                self._sums[chain_id].append(self._sums[chain_id][-1] + total)
+                self._squares[chain_id].append(self._squares[chain_id][-1] + squares)
+                (total, squares) = (0.0, 0.0)
+        self._partial[chain_id] = (total, squares)
+
+    def r_hat(self, min_samples):
+        num_blocks = min(len(sums) - 1 for sums in self._sums)
+        if num_blocks == self._num_blocks:
+            return self._r_hat
+        self._num_blocks = num_blocks
+        start = num_blocks // 2
+        length = (num_blocks - start) * self._block_size
+        if num_blocks * self._block_size < min_samples or len(self._sums) < 2 or length < 2:
+            self._r_hat = math.inf
+            return self._r_hat
+        totals = np.array([sums[num_blocks] - sums[start] for sums in self._sums])
+        squares = np.array([sums[num_blocks] - sums[start] for sums in self._squares])
+        means = totals / length
+        variances = np.maximum(squares - totals * means, 0.0) / (length - 1)
+        self._r_hat = _potential_scale_reduction(means, variances, length)
+        return self._r_hat
+
+
+def _run_chain(chain_id, seed, graph_size, edges, edge_prob_func, target_eval_func, monitor_statistics, initial_clustering, stop_event, report_queue, report_interval, kwargs):
+    """Run one chain of sample_chains() in a worker process."""
+    pending = []
+
+    def report_statistics(clustering):
+        value = float(monitor_statistics(clustering))
+        pending.append(value)
+        if len(pending) >= report_interval:
+            report_queue.put((chain_id, list(pending)))
+            del pending[:]
+        return value
+
+    sw = _SWCuts(seed)
+    clustering = sw.sample(
+        _AdjacencyGraph(graph_size, edges),
+        edge_prob_func,
+        target_eval_func,
+        initial_clustering=initial_clustering,
+        monitor_statistics_func=report_statistics,
+        stop_event=stop_event,
+        **kwargs)
+    if len(pending) > 0:
+        report_queue.put((chain_id, pending))
+    return (clustering, float(monitor_statistics(clustering)))
+
+
+def sample_replica_exchange(graph_size, edges, edge_prob_func, energy_func, temperatures, num_rounds=100, swap_interval=10, initial_clustering=None, seed=None, max_workers=None, **kwargs):
+    """Parallel tempering (replica exchange) by Swendsen-Wang Cuts.
+One replica per temperature samples exp(-energy/temperature) in a worker
+process for 'swap_interval' iterations. Then the states of neighboring
+temperatures are swapped with the Metropolis acceptance probability
+    min(1, exp((1/T_i - 1/T_j) * (E_i - E_j))).
+Even and odd neighbor pairs are attempted in alternate rounds.
+
+Parameters are the same as sample(), plus:
+- energy_func:
+    the energy of a clustering, replacing target_eval_func.
+        energy_func(clustering)
+
+- temperatures:
+    the temperature ladder, e.g. from geometric_temperatures().
+
+- num_rounds (optional):
+    number of rounds of sampling followed by swap attempts.
+
+- swap_interval (optional):
+    number of SW iterations of each replica in one round.
+
+- max_workers (optional):
+    number of worker processes, one per replica by default.
+
+Every replica stays in the same worker process, where its sampler is set
+up once and continued in every round. A replica whose own stop criteria
+from kwargs are met keeps its state in the following rounds.
+
+A model given in kwargs reads the replica temperature from
+context.fixed_temperature. All callbacks and the model shall be picklable.
+
+Returns a ReplicaExchangeResult.
+"""
+    num_replicas = len(temperatures)
+    seeds = np.random.SeedSequence(seed).spawn(num_replicas + 1)
+    rng = np.random.default_rng(seeds[-1])
+    clusterings = [initial_clustering] * num_replicas
+    energies = [math.inf] * num_replicas
+    best_clustering, best_energy = None, math.inf
+    swap_attempts = np.zeros(max(num_replicas - 1, 0), dtype=np.int64)
+    swap_accepts = np.zeros(max(num_replicas - 1, 0), dtype=np.int64)
+    if max_workers is None:
+        max_workers = num_replicas
+    num_workers = max(min(max_workers, num_replicas), 1)
+
+    # Replica k lives in worker k % num_workers for the whole run.
+    connections = []
+    workers = []
+    try:
+        for worker_id in range(0, num_workers):
+            (connection, worker_connection) = multiprocessing.Pipe()
+            replicas = [(k, temperatures[k], seeds[k]) for k in range(worker_id, num_replicas, num_workers)]
+            worker = multiprocessing.Process(
+                target=_run_replica_worker,
+                args=(worker_connection, graph_size, edges, edge_prob_func, energy_func, replicas, initial_clustering, kwargs))
+            worker.start()
+            worker_connection.close()
+            connections.append(connection)
+            workers.append(worker)
+
+        swapped = set()
+        for round_counter in range(0, num_rounds):
+            for (worker_id, connection) in enumerate(connections):
+                try:
+                    connection.send((swap_interval, {k: clusterings[k] for k in swapped if k % num_workers == worker_id}))
+                except OSError:
+                    # A failed worker has sent its error, received below.
+                    pass
+            for connection in connections:
+                results = connection.recv()
+                if isinstance(results, BaseException):
+                    raise results
+                for (k, clustering, energy) in results:
+                    clusterings[k], energies[k] = clustering, energy
+                    if energy < best_energy:
+                        best_clustering, best_energy = clustering, energy
+
+            # Metropolis swaps between neighboring temperatures.
+            swapped = set()
+            for k in range(round_counter % 2, num_replicas - 1, 2):
+                swap_attempts[k] += 1
+                log_ratio = (1.0/temperatures[k] - 1.0/temperatures[k+1]) * (energies[k] - energies[k+1])
+                if log_ratio >= 0 or rng.random() < math.exp(log_ratio):
+                    swap_accepts[k] += 1
+                    clusterings[k], clusterings[k+1] = clusterings[k+1], clusterings[k]
+                    energies[k], energies[k+1] = energies[k+1], energies[k]
+                    swapped.update((k, k + 1))
+    finally:
+        for connection in connections:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+        for worker in workers:
+            worker.join()
+
+    swap_acceptance_rates = [float(accepts)/float(attempts) if attempts > 0 else 0.0 for (accepts, attempts) in zip(swap_accepts, swap_attempts)]
+    return ReplicaExchangeResult(clusterings, energies, best_clustering, best_energy, swap_acceptance_rates)
+
+
+# Result of sample_replica_exchange().
+# - clusterings / energies: final state of every replica, in ladder order.
+# - best_clustering / best_energy: the lowest energy state seen.
+# - swap_acceptance_rates: acceptance rate of swaps between temperature k and k+1.
+ReplicaExchangeResult = namedtuple('ReplicaExchangeResult', ['clusterings', 'energies', 'best_clustering', 'best_energy', 'swap_acceptance_rates'])
+
+
+def geometric_temperatures(min_temperature, max_temperature, num_replicas):
+    """A temperature ladder with a constant ratio between neighbors."""
+    return list(np.geomspace(min_temperature, max_temperature, num_replicas))
+
+
+class _FixedTemperatureTarget(object):
+    """Log target exp(-energy/temperature) at a fixed temperature."""
+    def __init__(self, energy_func, temperature):
+        self._energy_func = energy_func
+        self._temperature = temperature
+
+    def __call__(self, clustering, context):
+        return -float(self._energy_func(clustering)) / self._temperature
+
+
+class _Replica(object):
+    """One replica of sample_replica_exchange(). The sampler is set up once,
+    with its tables and model statistics, and continued round after round."""
+    def __init__(self, adjacency_graph, edge_prob_func, energy_func, temperature, seed, initial_clustering, kwargs):
+        self._energy_func = energy_func
+        self._sw = _SWCuts(seed)
+        self._sw.context.fixed_temperature = temperature
+        self._samples = self._sw.iter_samples(
+            adjacency_graph,
+            edge_prob_func,
+            _FixedTemperatureTarget(energy_func, temperature),
+            initial_clustering=initial_clustering,
+            log_target=True,
+            **kwargs)
+
+    def run(self, iterations, clustering=None):
+        """Run a number of iterations, from 'clustering' if the state was
+        swapped with another replica."""
+        if clustering is not None:
+            self._sw._replace_state(clustering)
+        for unused_sample in itertools.islice(self._samples, iterations):
+            pass
+        clustering = self._sw._state.to_clustering()
+        return (clustering, float(self._energy_func(clustering)))
+
+
+def _run_replica_worker(connection, graph_size, edges, edge_prob_func, energy_func, replicas, initial_clustering, kwargs):
+    """Run some replicas of sample_replica_exchange() in a worker process,
+    one round per request, until None is received."""
+    try:
+        adjacency_graph = _AdjacencyGraph(graph_size, edges)
+        # Every replica gets its own copy of the model and the callbacks.
+        samplers = dict((k, _Replica(adjacency_graph, edge_prob_func, energy_func, temperature, seed, initial_clustering, copy.deepcopy(kwargs)))
+                        for (k, temperature, seed) in replicas)
+        request = connection.recv()
+        while request is not None:
+            (iterations, clusterings) = request
+            connection.send([(k,) + samplers[k].run(iterations, clusterings.get(k)) for k in sorted(samplers)])
+            request = connection.recv()
+    except Exception as e:
+        connection.send(e)
+    finally:
+        connection.close()
+
+
+# Target function of the candidate workers of sample(executor='process').
+_candidate_target_eval_func = None
+
+
+def _initialize_candidate_worker(target_eval_func):
+    global _candidate_target_eval_func
+    _candidate_target_eval_func = target_eval_func
+
+
+def _evaluate_candidates(target_eval_func, labels, component, to_labels, context):
+    """Evaluate the target after relabeling 'component' (vertex indexes) to
+    each of 'to_labels', given the label array before the move.
+    The process workers use the target function of their initializer."""
+    if target_eval_func is None:
+        target_eval_func = _candidate_target_eval_func
+    values = []
+    for to_label in to_labels:
+        moved_labels = labels.copy()
+        moved_labels[component] = to_label
+        values.append(target_eval_func(labels_to_clustering(moved_labels), context))
+    return values
+
+
+def labels_to_clustering(labels):
+    """Clustering as a list of sets, in ascending order of labels as
+    clustering_view()."""
+    order = np.argsort(labels, kind='stable')
+    (unused_labels, starts) = np.unique(labels[order], return_index=True)
+    return [set(group.tolist()) for group in np.split(order, starts[1:])]
+
+
+class SWSample(object):
+    """A sample yielded by iter_samples():
+    - iteration: the iteration counter.
+    - labels: cluster label of every vertex (read-only).
+    - moves: the Moves applied in this iteration.
+    - log_target: the log target of the sample, evaluated on first access.
+    A sample refers to the live state of the sampler, and is only valid
+    until the next sample is drawn. copy() keeps it."""
+    def __init__(self, iteration, labels, moves, sampler=None, log_target=None):
+        self.iteration = iteration
+        self.labels = labels
+        self.moves = moves
+        self._sampler = sampler
+        self._log_target = log_target
+
+    @property
+    def log_target(self):
+        if self._log_target is None and self._sampler is not None:
+            if self._sampler.context.iteration_counter != self.iteration:
+                raise RuntimeError('The sample has been replaced by a later one. Use copy() to keep it.')
+            self._log_target = self._sampler._current_log_target()
+        return self._log_target
+
+    def clustering(self):
+        """Clustering as a list of sets, copied from the sample."""
+        return labels_to_clustering(self.labels)
+
+    def copy(self):
+        """A copy which stays valid after the sampling goes on."""
+        return SWSample(self.iteration, self.labels.copy(), list(self.moves), log_target=self.log_target)
 
 
 class SWContext(object):
     def __init__(self):
         self.iteration_counter = 0
-        self.current_clustering = []
+        # Number of flipped components. It differs from the iteration
+        # counter when several components are flipped per iteration.
+        self.flip_counter = 0
+        # Set when the chain samples at a fixed temperature
+        # (e.g. a replica of sample_replica_exchange()).
+        self.fixed_temperature = None
+        # Set by the cooling schedule of the chain, if any.
+        self.temperature = None
+        self.stats = SWStats()
+        self._state = None
+        self._clustering = []
 
     def count_iteration(self):
         self.iteration_counter += 1
 
-    def set_result(self, current_clustering):
-        self.current_clustering = current_clustering
+    def count_flip(self):
+        self.flip_counter += 1
+
+    def set_state(self, state):
+        """Track the sampler state. The list-of-sets clustering is only
+        materialized when current_clustering is accessed."""
+        self._state = state
+        self._clustering = None
+
+    @property
+    def current_clustering(self):
+        if self._clustering is None:
+            self._clustering = self._state.to_clustering()
+        return self._clustering
+
+    def clustering_view(self):
+        """Clustering as a list of the live member sets, without copying.
+        The sets are modified by later moves and shall not be kept."""
+        return self._state.clustering_view()
+
+    @property
+    def current_labels(self):
+        """Cluster label of every vertex (read-only view)."""
+        labels = self._state.labels.view()
+        labels.flags.writeable = False
+        return labels
+
+
+class SWStats(object):
+    """Instrumentation of a chain: wall time spent in every phase of an
+    iteration, the histogram of the number of candidates per flip, how
+    often the selected move changed the clustering, and how many split and
+    merge proposals were accepted."""
+    PHASES = ('edge_sampling', 'component_formation', 'candidate_generation', 'target_evaluation', 'selection', 'split_merge')
+
+    def __init__(self):
+        super(SWStats, self).__init__()
+        self.phase_times = dict((phase, 0.0) for phase in self.PHASES)
+        self.candidate_counts = Counter()
+        self.num_flips = 0
+        # Flips which moved the component to another existing cluster,
+        # or to a new cluster. The remaining flips kept the clustering.
+        self.num_moves_to_existing = 0
+        self.num_moves_to_new = 0
+        # (proposed, accepted) split and merge proposals.
+        self.splits = [0, 0]
+        self.merges = [0, 0]
+
+    def add_time(self, phase, seconds):
+        self.phase_times[phase] += seconds
+
+    def record_flip(self, num_candidates, changed, to_new_cluster):
+        self.num_flips += 1
+        self.candidate_counts[num_candidates] += 1
+        if changed:
+            if to_new_cluster:
+                self.num_moves_to_new += 1
+            else:
+                self.num_moves_to_existing += 1
+
+    def record_split_merge(self, split, accepted):
+        counts = self.splits if split else self.merges
+        counts[0] += 1
+        if accepted:
+            counts[1] += 1
+
+    @property
+    def acceptance_rate(self):
+        """Fraction of flips which changed the clustering."""
+        if self.num_flips == 0:
+            return 0.0
+        return (self.num_moves_to_existing + self.num_moves_to_new) / float(self.num_flips)
+
+    def as_dict(self):
+        return {
+            'phase_times': dict(self.phase_times),
+            'candidate_counts': dict((str(k), v) for k, v in sorted(self.candidate_counts.items())),
+            'num_flips': self.num_flips,
+            'num_moves_to_existing': self.num_moves_to_existing,
+            'num_moves_to_new': self.num_moves_to_new,
+            'acceptance_rate': self.acceptance_rate,
+            'splits': list(self.splits),
+            'merges': list(self.merges)}
+
+
+class _StatsEmitter(object):
+    """Append the statistics of a chain as JSON lines."""
+    def __init__(self, filename, interval):
+        super(_StatsEmitter, self).__init__()
+        if interval < 1:
+            raise ValueError('stats_interval shall be a positive number of iterations.')
+        self._file = open(filename, 'a')
+        self._interval = interval
+        self._start_time = time.time()
+
+    def update(self, context, force=False):
+        if force or context.iteration_counter % self._interval == 0:
+            record = {
+                'iteration': context.iteration_counter,
+                'flips': context.flip_counter,
+                'elapsed': time.time() - self._start_time}
+            record.update(context.stats.as_dict())
+            self._file.write(json.dumps(record) + '\n')
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+# A move relabels every vertex of 'component' from 'from_label' to 'to_label'.
+# A move whose from_label equals to_label leaves the clustering unchanged.
+Move = namedtuple('Move', ['component', 'from_label', 'to_label'])
+
+
+class _ClusteringState(object):
+    """Clustering expressed as an integer label array with per-cluster
+    member sets and a pool of free labels, updated in place by moves."""
+    def __init__(self, size, clustering=None):
+        super(_ClusteringState, self).__init__()
+        if clustering is None:
+            clustering = [set(range(0, size))]
+
+        self.size = size
+        self.labels = np.full(size, -1, dtype=np.int64)
+        self._members = dict()
+        for (label, cluster) in enumerate(clustering):
+            for v in cluster:
+                if not (0 <= v < size) or self.labels[v] != -1:
+                    raise ValueError('Vertex {0} is out of range or appears in more than one cluster.'.format(v))
+                self.labels[v] = label
+            self._members[label] = set(cluster)
+        if np.any(self.labels == -1):
+            raise ValueError('Every vertex shall be assigned to a cluster.')
+
+        # Labels are allocated from the top of the pool and returned to it
+        # when a cluster becomes empty.
+        self._free_labels = list(range(size - 1, len(clustering) - 1, -1))
+
+    def __len__(self):
+        return len(self._members)
+
+    def __contains__(self, label):
+        return label in self._members
+
+    @classmethod
+    def from_labels(cls, labels, free_labels):
+        """Restore a state from its label array and free-label pool."""
+        state = cls.__new__(cls)
+        state.size = len(labels)
+        state.labels = np.array(labels, dtype=np.int64)
+        state._members = dict()
+        for (v, label) in enumerate(state.labels.tolist()):
+            state._members.setdefault(label, set()).add(v)
+        state._free_labels = [int(label) for label in free_labels]
+        return state
+
+    @property
+    def free_labels(self):
+        return self._free_labels
+
+    def label_of(self, v):
+        return self.labels[v]
+
+    def members(self, label):
+        return self._members[label]
+
+    def cluster_labels(self):
+        return sorted(self._members)
+
+    def peek_free_label(self):
+        """The label which the next new cluster will receive."""
+        return self._free_labels[-1]
+
+    def apply(self, move):
+        self._relabel(move.component, move.from_label, move.to_label)
+
+    def revert(self, move):
+        self._relabel(move.component, move.to_label, move.from_label)
+
+    def _relabel(self, component, from_label, to_label):
+        if from_label == to_label:
+            return
+        if to_label not in self._members:
+            if self._free_labels and self._free_labels[-1] == to_label:
+                self._free_labels.pop()
+            else:
+                self._free_labels.remove(to_label)
+            self._members[to_label] = set()
+
+        source = self._members[from_label]
+        target = self._members[to_label]
+        for v in component:
+            self.labels[v] = to_label
+        source -= component
+        target |= component
+        if len(source) == 0:
+            del self._members[from_label]
+            self._free_labels.append(from_label)
+
+    def clustering_view(self):
+        """Clustering as a list of the live member sets. The sets are
+        modified by later moves and shall not be kept by the caller."""
+        return [self._members[label] for label in self.cluster_labels()]
+
+    def to_clustering(self):
+        """Clustering as a list of sets, copied from the current state."""
+        return [set(self._members[label]) for label in self.cluster_labels()]
+
+
+class IncrementalModel(object):
+    """Protocol of models which score a move by its change of the log
+    target, keeping sufficient statistics of the current state on the
+    model side. 'state' exposes the label array ('labels'), the member set
+    of a cluster ('members(label)') and the live labels ('cluster_labels()')."""
+    def reset(self, state, context):
+        """Build the sufficient statistics of 'state'."""
+        raise NotImplementedError
+
+    def delta_log_target(self, move, state, context):
+        """Log target after 'move' minus the log target of 'state'.
+        'state' is not modified."""
+        raise NotImplementedError
+
+    def apply_move(self, move, state, context):
+        """Update the statistics after 'move' has been applied to 'state'."""
+        raise NotImplementedError
+
+    def revert_move(self, move, state, context):
+        """Update the statistics after 'move' has been reverted on 'state'."""
+        raise NotImplementedError
+
+    def log_target(self, state, context):
+        """Log target of 'state', e.g. for SWSample.log_target and the cooling
+        schedules. None if the model cannot tell; target_eval_func is then
+        evaluated instead."""
+        return None
+
+    def batch_target_eval(self, state, moves, context):
+        """delta_log_target() of every candidate move of a flip, as an array.
+        Models may override it to share the terms of unchanged clusters among
+        the candidates and to score the changed clusters together."""
+        return np.array([self.delta_log_target(move, state, context) for move in moves], dtype=np.float64)
+
+
+class ClusterEnergyModel(IncrementalModel):
+    """IncrementalModel for energies which decompose over clusters:
+        energy = sum(cluster_energy(cluster)) + num_clusters_energy(len(clustering))
+    with target exp(-energy/temperature(context)).
+    A move only touches two clusters, so each delta costs two cluster terms.
+    The energies of the current clusters and their sum are cached from
+    reset() on, and kept up to date by apply_move() and revert_move()."""
+    _cluster_energies = None
+    _energy_sum = 0.0
+
+    def cluster_energy(self, cluster):
+        raise NotImplementedError
+
+    def num_clusters_energy(self, num_clusters):
+        return 0.0
+
+    def temperature(self, context):
+        """Used when the chain has neither a fixed temperature nor a cooling schedule."""
+        return 1.0
+
+    def reset(self, state, context):
+        self._cluster_energies = dict()
+        for label in state.cluster_labels():
+            self._cluster_energies[label] = self.cluster_energy(state.members(label))
+        self._energy_sum = sum(self._cluster_energies.values())
+
+    def current_energy(self):
+        """Energy of the current state, from the cached cluster energies.
+        None before reset()."""
+        if self._cluster_energies is None:
+            return None
+        return self._energy_sum + self.num_clusters_energy(len(self._cluster_energies))
+
+    def log_target(self, state, context):
+        """Log target of 'state', from the cached cluster energies."""
+        return -float(self.current_energy()) / self._current_temperature(context)
+
+    def _current_temperature(self, context):
+        if context.fixed_temperature is not None:
+            return context.fixed_temperature
+        if context.temperature is not None:
+            return context.temperature
+        return self.temperature(context)
+
+    def delta_log_target(self, move, state, context):
+        if move.from_label == move.to_label:
+            return 0.0
+        num_clusters = len(state)
+        new_num_clusters = num_clusters
+
+        source = state.members(move.from_label)
+        delta = -self._cluster_energies[move.from_label]
+        if len(source) > len(move.component):
+            delta += self.cluster_energy(source - move.component)
+        else:
+            new_num_clusters -= 1
+
+        if move.to_label in state:
+            delta += self.cluster_energy(state.members(move.to_label) | move.component)
+            delta -= self._cluster_energies[move.to_label]
+        else:
+            delta += self.cluster_energy(set(move.component))
+            new_num_clusters += 1
+
+        delta += self.num_clusters_energy(new_num_clusters) - self.num_clusters_energy(num_clusters)
+        return -float(delta) / self._current_temperature(context)
+
+    def apply_move(self, move, state, context):
+        self._update_cluster_energies(move, state)
+
+    def revert_move(self, move, state, context):
+        self._update_cluster_energies(move, state)
+
+    def _update_cluster_energies(self, move, state, energies=None):
+        """Refresh the energies of the two clusters of 'move', taken from
+        'energies' (by label) when known."""
+        if move.from_label == move.to_label:
+            return
+        for label in (move.from_label, move.to_label):
+            self._energy_sum -= self._cluster_energies.pop(label, 0.0)
+            if label in state:
+                if energies is not None and label in energies:
+                    self._cluster_energies[label] = energies[label]
+                else:
+                    self._cluster_energies[label] = self.cluster_energy(state.members(label))
+                self._energy_sum += self._cluster_energies[label]
+
+
+# Cuts up to this number of edges are handled by plain Python loops,
+# which are faster than NumPy for small arrays.
+_SMALL_CUT_SIZE = 64
 
 
 class _AdjacencyGraph(object):
-    """Adjacency Graph on which to perform Swendsen-Wang Cuts."""
+    """Adjacency Graph on which to perform Swendsen-Wang Cuts, in CSR form:
+    the neighbors of vertex v are indices[indptr[v]:indptr[v+1]], joined
+    by the edges edge_ids[indptr[v]:indptr[v+1]]."""
     def __init__(self, size, edges):
         """size is a integer.
-        Edges is a list of edge tuples. i.e. [ (s, t) ]. """
+        Edges is a list of edge tuples. i.e. [ (s, t) ].
+        The id of an edge is its index in the list. A repeated edge is
+        identified by its first occurrence."""
         super(_AdjacencyGraph, self).__init__()
 
         self.size = size
-        self.edges = set()
-        self.adj_list = defaultdict(list)
+        edge_array = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        if len(edge_array) > 0 and (edge_array.min() < 0 or edge_array.max() >= size):
+            raise ValueError('More vertex given than the size of the graph.')
 
-        for (start, end) in edges:
-            if start > end:
-                start, end = end, start
-            self.edges.add((start, end))
-            try:
-                assert(start in range(0, size) and end in range(0, size))
-            except AssertionError:
-                raise ValueError('More vertex given than the size of the graph.')
-            self.adj_list[start].append(end)
-            self.adj_list[end].append(start)
-        return
+        # Edges in the given order with s < t, used by the vectorized path.
+        self.num_edges = len(edge_array)
+        self.edge_sources = edge_array.min(axis=1).astype(np.int32)
+        self.edge_targets = edge_array.max(axis=1).astype(np.int32)
 
+        # Ids of the distinct edges, in ascending order.
+        keys = self.edge_sources.astype(np.int64) * size + self.edge_targets
+        self.unique_edge_ids = np.sort(np.unique(keys, return_index=True)[1]).astype(np.int32)
+        # Mask of the first occurrences, or None when no edge is repeated.
+        self.unique_edge_mask = None
+        if len(self.unique_edge_ids) < self.num_edges:
+            self.unique_edge_mask = np.zeros(self.num_edges, dtype=bool)
+            self.unique_edge_mask[self.unique_edge_ids] = True
 
-class _ConvergenceMonitor(object):
-    def __init__(self, monitor_func, epsilon=0, stationary_steps=1000):
+        ids = self.unique_edge_ids
+        ends = np.concatenate([self.edge_sources[ids], self.edge_targets[ids]])
+        order = np.argsort(ends, kind='stable')
+        self.indptr = np.zeros(size + 1, dtype=np.int32)
+        np.cumsum(np.bincount(ends, minlength=size), out=self.indptr[1:])
+        self.indices = np.concatenate([self.edge_targets[ids], self.edge_sources[ids]])[order]
+        self.edge_ids = np.concatenate([ids, ids])[order]
+
+    def incident_edges(self, vertices):
+        """Neighbors of the vertexes and the ids of the joining edges."""
+        if len(vertices) == 1:
+            (start, end) = (self.indptr[vertices[0]], self.indptr[vertices[0] + 1])
+            return (self.indices[start:end], self.edge_ids[start:end])
+        starts = self.indptr[vertices]
+        counts = self.indptr[vertices + 1] - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts))
+        return (self.indices[offsets], self.edge_ids[offsets])
+
+
+class StationaryCriterion(object):
+    """Met when the statistics stay within a tolerance for a number of
+    iterations. The tolerance is 'epsilon', or 'epsilon' times the largest
+    absolute value in the window if 'relative' is True.
+    The window is tracked by monotonic min/max queues, so every update has
+    constant amortized cost and memory is bounded by the window."""
+    def __init__(self, monitor_func, epsilon=0, stationary_steps=1000, relative=False):
         self._monitor_statistics_func = monitor_func
         self._epsilon = epsilon
         self._stationary_steps = stationary_steps
-        self._history = []
-        self._window = (0, 0)
+        self._relative = relative
+        # Index of the next statistics and start of the window.
+        self._count = 0
+        self._window_start = 0
+        # (index, value) pairs with decreasing / increasing values.
+        self._max_queue = deque()
+        self._min_queue = deque()
+
+    def update(self, context):
+        value = float(self._monitor_statistics_func(context.clustering_view()))
+        index = self._count
+        self._count += 1
+
+        while self._max_queue and self._max_queue[-1][1] <= value:
+            self._max_queue.pop()
+        self._max_queue.append((index, value))
+        while self._min_queue and self._min_queue[-1][1] >= value:
+            self._min_queue.pop()
+        self._min_queue.append((index, value))
+
+        # Shrink the window until its range is within tolerance.
+        while self._max_queue[0][1] - self._min_queue[0][1] > self._tolerance():
+            if self._max_queue[0][0] < self._min_queue[0][0]:
+                self._window_start = self._max_queue.popleft()[0] + 1
+            else:
+                self._window_start = self._min_queue.popleft()[0] + 1
+
+        return (index - self._window_start) >= self._stationary_steps
+
+    def _tolerance(self):
+        if self._relative:
+            return self._epsilon * max(abs(self._max_queue[0][1]), abs(self._min_queue[0][1]))
+        return self._epsilon
+
+    def get_state(self):
+        return {
+            'count': self._count,
+            'window_start': self._window_start,
+            'max_queue': list(self._max_queue),
+            'min_queue': list(self._min_queue)}
+
+    def set_state(self, state):
+        self._count = state['count']
+        self._window_start = state['window_start']
+        self._max_queue = deque(tuple(item) for item in state['max_queue'])
+        self._min_queue = deque(tuple(item) for item in state['min_queue'])
+
+
+class TimeBudget(object):
+    """Met when the sampling has taken 'seconds' of wall time. Time spent
+    before a checkpoint counts when the sampling is resumed."""
+    def __init__(self, seconds):
+        self._seconds = seconds
+        self._elapsed = 0.0
+        self._last_time = None
+
+    def update(self, context):
+        now = time.monotonic()
+        if self._last_time is not None:
+            self._elapsed += now - self._last_time
+        self._last_time = now
+        return self._elapsed >= self._seconds
+
+    def get_state(self):
+        return {'elapsed': self._elapsed}
+
+    def set_state(self, state):
+        self._elapsed = state['elapsed']
+        self._last_time = None
+
+
+class IterationBudget(object):
+    """Met when the sampling has run 'iterations' iterations."""
+    def __init__(self, iterations):
+        self._iterations = iterations
+
+    def update(self, context):
+        return context.iteration_counter >= self._iterations
+
+    def get_state(self):
+        return {}
+
+    def set_state(self, state):
+        pass
+
+
+class _ConvergenceMonitor(object):
+    """Stops the sampling when any of the criteria is met.
+    Every criterion is updated at every iteration."""
+    def __init__(self, criteria):
+        self._criteria = list(criteria)
 
     def has_converged(self, context):
-        if self._monitor_statistics_func is None:
-            return False
-
-        current_statistics = self._monitor_statistics_func(context.current_clustering)
-        # record history
-        self._history.append(current_statistics)
-        # adjust convergence window
-        self._window = (self._window[0], len(self._history) - 1)
-
-        values_in_window = self._history[self._window[0]: self._window[1]+1]
-        while max(values_in_window) - min(values_in_window) > self._epsilon:
-            self._window = (self._window[0]+1, self._window[1])
-            values_in_window = self._history[self._window[0]: self._window[1]+1]
-
-        if self._window[1]-self._window[0] < self._stationary_steps:
-            return False
-        else:
-            return True
+        converged = False
+        for criterion in self._criteria:
+            if criterion.update(context):
+                converged = True
+        return converged
+
+    def get_state(self):
+        return [criterion.get_state() for criterion in self._criteria]
+
+    def set_state(self, states):
+        if len(states) != len(self._criteria):
+            raise ValueError('The checkpoint does not match the stop criteria.')
+        for (criterion, state) in zip(self._criteria, states):
+            criterion.set_state(state)
 
 
 class _SWCuts(object):
     """Swendsen-Wang cuts."""
-    def __init__(self):
+    def __init__(self, seed=None):
         super(_SWCuts, self).__init__()
         self.context = SWContext()
+        self._rng = np.random.default_rng(seed)
 
-    def sample(self, adjacency_graph, edge_prob_func, target_eval_func, intermediate_callback=None, initial_clustering=None, monitor_statistics_func=None):
-        # Initial labeling.
-        if initial_clustering is not None:
-            current_clustering = initial_clustering
-        else:
-            current_clustering = [set(range(0, adjacency_graph.size))]
+    def sample(self, adjacency_graph, edge_prob_func, target_eval_func, intermediate_callback=None, **kwargs):
+        for unused_sample in self.iter_samples(adjacency_graph, edge_prob_func, target_eval_func, **kwargs):
+            # Propagate intermediate result if has callback function.
+            if intermediate_callback is not None:
+                intermediate_callback(self.context.current_clustering, self.context)
+        return self._state.to_clustering()
+
+    def iter_samples(self, adjacency_graph, edge_prob_func, target_eval_func, initial_clustering=None, monitor_statistics_func=None, edge_probs_func=None, log_target=False, log_edge_off_func=None, model=None, stop_event=None, checkpoint_file=None, checkpoint_interval=100, resume=False, stop_criteria=None, sweep=None, static_edge_probs=False, stats_file=None, stats_interval=100, executor=None, max_workers=None, cooling_schedule=None, split_merge_ratio=0.0, split_merge_distance_func=None):
+        """Set up the sampling and return the generator of samples.
+        The setup is done here, so that invalid arguments are reported
+        before the first sample is drawn."""
+        if executor not in (None, 'thread', 'process'):
+            raise ValueError("executor shall be 'thread' or 'process'.")
 
+        # Initial labeling.
+        self._state = _ClusteringState(adjacency_graph.size, initial_clustering)
         self._adjacency_graph = adjacency_graph
+        self._in_component = np.zeros(adjacency_graph.size, dtype=bool)
 
         # Functions
         self._edge_prob_func = edge_prob_func
+        self._edge_probs_func = edge_probs_func
+        self._edge_probs = None
+        self._static_edge_probs = None
+        self._edge_log_off = None
         self._target_eval_func = target_eval_func
-        self._convergence_monitor = _ConvergenceMonitor(monitor_statistics_func)
+        self._log_target = log_target
+        self._log_edge_off_func = log_edge_off_func
+        criteria = []
+        if monitor_statistics_func is not None:
+            criteria.append(StationaryCriterion(monitor_statistics_func))
+        if stop_criteria is not None:
+            criteria.extend(stop_criteria)
+        self._convergence_monitor = _ConvergenceMonitor(criteria)
+        self._stop_event = stop_event
+        if sweep is not None and not (0 < sweep <= 1):
+            raise ValueError('sweep shall be a fraction in (0, 1].')
+        self._sweep = sweep
+        self._cooling_schedule = cooling_schedule
+        if not (0 <= split_merge_ratio < 1):
+            raise ValueError('split_merge_ratio shall be a fraction in [0, 1).')
+        if split_merge_ratio > 0 and split_merge_distance_func is None:
+            raise ValueError('split_merge_distance_func is required by split_merge_ratio.')
+        self._split_merge_ratio = split_merge_ratio
+        self._distance_func = split_merge_distance_func
 
-        self.context.set_result(current_clustering)
+        if resume and checkpoint_file is not None and os.path.exists(checkpoint_file):
+            self._load_checkpoint(checkpoint_file)
+            if self._state.size != adjacency_graph.size:
+                raise ValueError('The checkpoint does not match the size of the graph.')
 
-        while not self._has_converged():
-            self.context.count_iteration()
+        # Incremental scoring when the model supports it.
+        self._model = None
+        if model is not None and getattr(model, 'delta_log_target', None) is not None:
+            self._model = model
+            self._batch_target_eval = getattr(model, 'batch_target_eval', None)
+            if self._batch_target_eval is None:
+                self._batch_target_eval = self._batch_delta_log_target
 
-            # Determine edge status (on or off) probabilistically.
-            edge_status = self._determine_edge_status()
+        self.context.set_state(self._state)
+        if self._model is not None:
+            self._model.reset(self._state, self.context)
+        # An array of edge probabilities is static by nature. Without
+        # edge_prob_func, the probabilities come from edge_probs_func.
+        if not (edge_prob_func is None and edge_probs_func is not None):
+            if static_edge_probs or not callable(edge_prob_func):
+                self._setup_static_edge_probs()
+        if split_merge_ratio > 0:
+            self._setup_split_merge()
+        if cooling_schedule is not None:
+            if cooling_schedule.uses_energy and self._model is None and target_eval_func is None:
+                raise ValueError('The cooling schedule needs the energy from the model or target_eval_func.')
+            cooling_schedule.initialize(self.context)
+            self.context.temperature = cooling_schedule.temperature
+        return self._iterate(checkpoint_file, checkpoint_interval, stats_file, stats_interval, executor, max_workers)
 
-            # Form connected components over the whole space.
-            connected_components = self._form_connected_components(
-                current_clustering, edge_status)
+    def _iterate(self, checkpoint_file, checkpoint_interval, stats_file, stats_interval, executor, max_workers):
+        self._executor = None
+        if executor == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        elif executor == 'process':
+            self._executor = ProcessPoolExecutor(
+                max_workers=max_workers, initializer=_initialize_candidate_worker, initargs=(self._target_eval_func,))
+        self._num_workers = max_workers or os.cpu_count() or 1
 
-            # Option 1: Do a sweep.
-            #  for component in connected_components:
-            # Option 2: only randomly select one component.
-            component = connected_components[random.randint(0, len(connected_components)-1)]
-            # Flip the connect component probabilistically.
-            current_clustering = self._flip_connected_component(
-                current_clustering, component)
-            self.context.set_result(current_clustering)
+        stats = self.context.stats
+        stats_emitter = _StatsEmitter(stats_file, stats_interval) if stats_file is not None else None
+        try:
+            while not self._has_converged():
+                self.context.count_iteration()
 
-            # Propagate intermediate result if has callback function.
-            if intermediate_callback is not None:
-                intermediate_callback(copy.copy(current_clustering), self.context)
+                if self._split_merge_ratio > 0 and self._rng.random() < self._split_merge_ratio:
+                    start = time.perf_counter()
+                    move = self._propose_split_merge()
+                    moves = [] if move is None else [move]
+                    stats.add_time('split_merge', time.perf_counter() - start)
+                else:
+                    moves = self._swendsen_wang_cuts()
+                self.context.set_state(self._state)
+
+                labels = self._state.labels.view()
+                labels.flags.writeable = False
+                stopped = False
+                try:
+                    yield SWSample(self.context.iteration_counter, labels, moves, sampler=self)
+                except GeneratorExit:
+                    # The consumer stopped. The state is complete between
+                    # iterations, so it is finished up as if converged.
+                    stopped = True
+
+                if self._cooling_schedule is not None:
+                    self._update_cooling_schedule()
+                if stopped:
+                    break
+
+                if checkpoint_file is not None and self.context.iteration_counter % checkpoint_interval == 0:
+                    self._save_checkpoint(checkpoint_file)
+                if stats_emitter is not None:
+                    stats_emitter.update(self.context)
+
+            if checkpoint_file is not None:
+                self._save_checkpoint(checkpoint_file)
+            if stats_emitter is not None:
+                stats_emitter.update(self.context, force=True)
+        finally:
+            if stats_emitter is not None:
+                stats_emitter.close()
+            if self._executor is not None:
+                self._executor.shutdown()
+
+    def _swendsen_wang_cuts(self):
+        """One iteration of Swendsen-Wang Cuts. Returns the selected moves."""
+        stats = self.context.stats
+
+        # Determine edge status (on or off) probabilistically.
+        start = time.perf_counter()
+        if self._edge_probs_func is not None or self._static_edge_probs is not None:
+            edge_on = self._determine_edge_status_vectorized()
+        else:
+            edge_on = self._determine_edge_status()
+        formation_start = time.perf_counter()
+        stats.add_time('edge_sampling', formation_start - start)
+
+        # Form connected components within the clusters.
+        components = self._select_connected_components(edge_on)
+        stats.add_time('component_formation', time.perf_counter() - formation_start)
+
+        # Flip the connect components probabilistically, one after another.
+        moves = []
+        for component in components:
+            moves.append(self._flip_connected_component(component))
+            self.context.count_flip()
+        return moves
+
+    def _current_log_target(self):
+        """Log target of the current state, from the model if it keeps the
+        cluster terms, otherwise by target_eval_func."""
+        model_log_target = getattr(self._model, 'log_target', None)
+        if model_log_target is not None:
+            value = model_log_target(self._state, self.context)
+            if value is not None:
+                return float(value)
+        if self._target_eval_func is None:
+            return None
+        value = self._target_eval_func(self._state.clustering_view(), self.context)
+        if self._log_target:
+            return float(value)
+        return float(mpmath.log(value))
+
+    def _update_cooling_schedule(self):
+        """Update the schedule with the iteration sampled at context.temperature,
+        and set the temperature of the next iteration."""
+        energy = None
+        if self._cooling_schedule.uses_energy:
+            energy = -self._current_log_target() * self.context.temperature
+        self._cooling_schedule.update(self.context, energy)
+        self.context.temperature = self._cooling_schedule.temperature
 
-        return current_clustering
+    def _save_checkpoint(self, filename):
+        """Save the sampler state. The file is replaced atomically."""
+        temporary_filename = filename + '.tmp'
+        with open(temporary_filename, 'wb') as f:
+            np.savez(
+                f,
+                labels=self._state.labels,
+                free_labels=np.array(self._state.free_labels, dtype=np.int64),
+                iteration_counter=self.context.iteration_counter,
+                flip_counter=self.context.flip_counter,
+                rng_state=json.dumps(self._rng.bit_generator.state),
+                monitor_state=json.dumps(self._convergence_monitor.get_state()),
+                cooling_schedule=self._cooling_schedule_name(),
+                cooling_state=json.dumps(None if self._cooling_schedule is None else self._cooling_schedule.get_state()))
+        os.replace(temporary_filename, filename)
+
+    def _load_checkpoint(self, filename):
+        with np.load(filename) as checkpoint:
+            self._state = _ClusteringState.from_labels(checkpoint['labels'], checkpoint['free_labels'])
+            self.context.iteration_counter = int(checkpoint['iteration_counter'])
+            self.context.flip_counter = int(checkpoint['flip_counter'])
+            self._rng.bit_generator.state = json.loads(str(checkpoint['rng_state']))
+            self._convergence_monitor.set_state(json.loads(str(checkpoint['monitor_state'])))
+            if 'cooling_schedule' in checkpoint and str(checkpoint['cooling_schedule']) != self._cooling_schedule_name():
+                raise ValueError('The checkpoint does not match the cooling schedule.')
+            if self._cooling_schedule is not None and 'cooling_state' in checkpoint:
+                cooling_state = json.loads(str(checkpoint['cooling_state']))
+                if cooling_state is not None:
+                    self._cooling_schedule.set_state(cooling_state)
+
+    def _cooling_schedule_name(self):
+        return '' if self._cooling_schedule is None else type(self._cooling_schedule).__name__
+
+    def _replace_state(self, clustering):
+        """Continue the sampling from another clustering."""
+        self._state = _ClusteringState(self._adjacency_graph.size, clustering)
+        self.context.set_state(self._state)
+        if self._model is not None:
+            self._model.reset(self._state, self.context)
 
     def _has_converged(self):
         """Convergence Test."""
+        if self._stop_event is not None and self._stop_event.is_set():
+            return True
         return self._convergence_monitor.has_converged(self.context)
 
-    def _edge_on_probability(self, s, t):
-        # Ensure s < t
-        if s > t:
-            s, t = t, s
+    def _edge_end_points(self, edge_id):
+        graph = self._adjacency_graph
+        return (int(graph.edge_sources[edge_id]), int(graph.edge_targets[edge_id]))
+
+    def _setup_static_edge_probs(self):
+        """Tabulate q and log(1 - q) of every edge once."""
+        graph = self._adjacency_graph
+        edge_list = list(zip(graph.edge_sources.tolist(), graph.edge_targets.tolist()))
+        if callable(self._edge_prob_func):
+            edge_probs = [float(self._edge_prob_func(s, t, self.context)) for (s, t) in edge_list]
+        else:
+            edge_probs = self._edge_prob_func
+        edge_probs = np.asarray(edge_probs, dtype=np.float64)
+        if edge_probs.shape != (graph.num_edges,):
+            raise ValueError('Static edge probabilities shall be given for every edge.')
+
+        if self._log_edge_off_func is not None:
+            edge_log_off = np.array([float(self._log_edge_off_func(s, t, self.context)) for (s, t) in edge_list])
+        else:
+            with np.errstate(divide='ignore'):
+                edge_log_off = np.log1p(-np.minimum(edge_probs, 1.0))
+
+        self._static_edge_probs = edge_probs
+        self._edge_probs = edge_probs
+        self._edge_log_off = edge_log_off
+
+    def _edge_on_probability(self, edge_id):
+        if self._edge_probs is not None:
+            return self._edge_probs[edge_id]
+        (s, t) = self._edge_end_points(edge_id)
         return self._edge_prob_func(s, t, self.context)
 
+    def _edge_log_off_weight(self, edge_id):
+        """log(1 - q) of an edge in float64."""
+        if self._edge_log_off is not None:
+            return self._edge_log_off[edge_id]
+        if self._log_edge_off_func is not None:
+            (s, t) = self._edge_end_points(edge_id)
+            return self._log_edge_off_func(s, t, self.context)
+        q = float(self._edge_on_probability(edge_id))
+        if q >= 1:
+            return -math.inf
+        return math.log1p(-q)
+
+    def _cut_log_weight(self, cut_set):
+        """Sum of log(1 - q) over the edges of a cut."""
+        if self._edge_log_off is not None and len(cut_set) > _SMALL_CUT_SIZE:
+            return float(np.sum(self._edge_log_off[cut_set]))
+        log_weight = 0.0
+        for edge_id in cut_set:
+            log_weight += self._edge_log_off_weight(edge_id)
+        return log_weight
+
     def _determine_edge_status(self):
-        edge_status = defaultdict(dict)
-        for (s, t) in self._adjacency_graph.edges:
+        """Status (on or off) of every edge, by edge id."""
+        edge_on = np.zeros(self._adjacency_graph.num_edges, dtype=bool)
+        for edge_id in self._adjacency_graph.unique_edge_ids.tolist():
             # Determine the status of each edge probabilistically.
             # Turn edge 'on' if r < prob(on), 'off' otherwise.
-            r = random.random()
-            if (r < self._edge_on_probability(s, t)):
-                edge_status[s][t] = True
-                edge_status[t][s] = True
-            else:
-                edge_status[s][t] = False
-                edge_status[t][s] = False
-        return edge_status
-
-    def _form_connected_components(self, current_clustering, edge_status):
-        """Form connected components (CP) probabilistically.
-        This function returns a list of CPs. Each CP is a list of vertexes."""
-        size = self._adjacency_graph.size
-        visited = [False for v in range(0, size)]
-
-        connected_components = []
-        for cluster in current_clustering:
-            for v in cluster:
-                if not visited[v]:
-                    seed_vertex = v
-                    # Form one CP from a random vertex
-                    # seed_vertex = random.randint(0, size-1)
-                    component = self._grow_component_by_bfs(
-                        seed_vertex, cluster, edge_status, visited)
-                    connected_components.append(component)
-
-        return connected_components
-
-    def _grow_component_by_bfs(self, seed_vertex, host_cluster, edge_status, visited):
-        component = set()
-        d = deque([seed_vertex])
-        while(len(d) != 0):
-            v = d.popleft()
-            if visited[v]:
-                continue
-
-            visited[v] = True
-            component.add(v)
-
-            # Add all connected vertex into the queue.
-            for u in self._adjacency_graph.adj_list[v]:
-                if u in host_cluster:
-                    if edge_status[v][u]:
-                        d.append(u)
-        return component
-
-    def _flip_connected_component(self, current_clustering, component):
-        # Cache the cluster index of every vertex.
-        cluster_dict = dict()
-        for (cluster_index, cluster) in enumerate(current_clustering):
-            for v in cluster:
-                cluster_dict[v] = cluster_index
-        assert(len(cluster_dict) == self._adjacency_graph.size)
+            r = self._rng.random()
+            edge_on[edge_id] = r < self._edge_on_probability(edge_id)
+        return edge_on
 
-        for v in component:
-            host_cluster_index = cluster_dict[v]
-            break
+    def _select_component_indexes(self, num_components):
+        """Indexes of the components to flip in this iteration:
+        one uniformly selected, or a random subset in random order (sweep)."""
+        if self._sweep is None:
+            return [self._rng.integers(num_components)]
+        num_selected = max(1, int(round(self._sweep * num_components)))
+        return self._rng.permutation(num_components)[0:num_selected]
 
-        # Find all neighbor clusters of the component.
-        neighbor_clusters = set()
-        cut_edges_dict = defaultdict(set)
+    def _determine_edge_status_vectorized(self):
+        """Draw the status of all edges at once. A repeated edge is drawn
+        once, at its first occurrence, as in _determine_edge_status()."""
+        graph = self._adjacency_graph
+        if self._static_edge_probs is not None:
+            edge_probs = self._static_edge_probs
+        else:
+            edge_probs = np.asarray(self._edge_probs_func(self.context), dtype=np.float64)
+            if edge_probs.shape != (graph.num_edges,):
+                raise ValueError('edge_probs_func shall return one probability per edge.')
+            self._edge_probs = edge_probs
+        edge_on = self._rng.random(graph.num_edges) < edge_probs
+        if graph.unique_edge_mask is not None:
+            edge_on &= graph.unique_edge_mask
+        return edge_on
 
-        for v in component:
-            for u in self._adjacency_graph.adj_list[v]:
+    def _select_connected_components(self, edge_on):
+        """Form connected components (CP) of the 'on' edges within the
+        current clusters, and select the ones to flip.
+        This function returns a list of CPs. Each CP is a set of vertexes.
+        CPs are numbered in the order of their smallest vertex."""
+        graph = self._adjacency_graph
+        labels = self._state.labels
+        sources, targets = graph.edge_sources, graph.edge_targets
+        edge_on = edge_on & (labels[sources] == labels[targets])
+        on_graph = coo_matrix(
+            (np.ones(np.count_nonzero(edge_on), dtype=np.int8), (sources[edge_on], targets[edge_on])),
+            shape=(graph.size, graph.size))
+        num_components, component_ids = connected_components(on_graph, directed=False)
+
+        selected = self._select_component_indexes(num_components)
+        if len(selected) == 1:
+            return [set(np.flatnonzero(component_ids == selected[0]).tolist())]
+        # Group vertexes by component in one pass.
+        order = np.argsort(component_ids, kind='stable')
+        bounds = np.cumsum(np.bincount(component_ids, minlength=num_components))
+        groups = np.split(order, bounds[:-1])
+        return [set(groups[c].tolist()) for c in selected]
+
+    def _generate_candidates(self, component):
+        """Generate the candidate moves of a component.
+        Each candidate is a tuple (move, cut_set), where cut_set is the
+        list of ids of the edges between the component and the cluster."""
+        state = self._state
+        labels = state.labels
+        vertices = np.fromiter(component, dtype=np.int64, count=len(component))
+        host_label = int(labels[vertices[0]])
+
+        # Find all edges leaving the component, grouped by neighbor cluster.
+        (neighbors, edge_ids) = self._adjacency_graph.incident_edges(vertices)
+        if len(neighbors) <= _SMALL_CUT_SIZE:
+            cut_edges_dict = defaultdict(list)
+            for (u, label, edge_id) in zip(neighbors.tolist(), labels[neighbors].tolist(), edge_ids.tolist()):
                 if u not in component:
-                    neighbor_cluster_index = cluster_dict[u]
-                    neighbor_clusters.add(neighbor_cluster_index)
-                    cut_edges_dict[neighbor_cluster_index].add((v, u))
+                    cut_edges_dict[label].append(edge_id)
+            cut_labels = sorted(cut_edges_dict)
+            cut_sets = [cut_edges_dict[label] for label in cut_labels]
+        else:
+            self._in_component[vertices] = True
+            leaving = ~self._in_component[neighbors]
+            self._in_component[vertices] = False
+            neighbor_labels = labels[neighbors[leaving]]
+            order = np.argsort(neighbor_labels, kind='stable')
+            sorted_labels = neighbor_labels[order]
+            sorted_edge_ids = edge_ids[leaving][order]
+            bounds = (np.flatnonzero(sorted_labels[1:] != sorted_labels[:-1]) + 1).tolist()
+            starts = [0] + bounds
+            cut_labels = sorted_labels[starts].tolist() if len(sorted_labels) > 0 else []
+            cut_sets = [sorted_edge_ids[i:j].tolist() for (i, j) in zip(starts, bounds + [len(sorted_labels)])]
 
-        # Generate candidates
-        # Each element is a tuple (candidate_clustering, cut_set)
         candidates = []
 
         # 1. Merge the component to one of the neighbor
         #    and remove from its host cluster.
-        for neighbor_cluster_index in neighbor_clusters:
-            candidate = copy.deepcopy(current_clustering)
-            if neighbor_cluster_index != host_cluster_index:
-                for v in component:
-                    candidate[neighbor_cluster_index].add(v)
-                if current_clustering[host_cluster_index] == component:
-                    candidate.remove(component)
-                else:
-                    candidate[host_cluster_index] -= component
-            candidates.append((candidate, cut_edges_dict[neighbor_cluster_index]))
+        for (neighbor_label, cut_set) in zip(cut_labels, cut_sets):
+            candidates.append((Move(component, host_label, neighbor_label), cut_set))
 
         # 2. Add component as a new cluster.
-        new_candidate = copy.deepcopy(current_clustering)
-        if current_clustering[host_cluster_index] != component:
-            new_candidate[host_cluster_index] -= component
-            new_candidate.append(component)
-        candidates.append((new_candidate, set()))
+        if len(state.members(host_label)) == len(component):
+            new_label = host_label
+        else:
+            new_label = state.peek_free_label()
+        candidates.append((Move(component, host_label, new_label), []))
+        return candidates
 
-        # Calculate the posterior probability of each candidate.
+    def _evaluate_target(self, move):
+        """Evaluate the target on the clustering after the move, by applying
+        and reverting the move in place."""
+        self._state.apply(move)
+        try:
+            return self._target_eval_func(self._state.clustering_view(), self.context)
+        finally:
+            self._state.revert(move)
+
+    def _evaluate_targets(self, moves):
+        """Evaluate the target after each of the moves of a component,
+        fanned out to the executor if any."""
+        if self._executor is None or len(moves) == 1:
+            return [self._evaluate_target(move) for move in moves]
+
+        component = np.fromiter(moves[0].component, dtype=np.int64, count=len(moves[0].component))
+        # Workers receive a copy of the counters only.
+        context = SWContext()
+        context.iteration_counter = self.context.iteration_counter
+        context.flip_counter = self.context.flip_counter
+        context.fixed_temperature = self.context.fixed_temperature
+        context.temperature = self.context.temperature
+        target_eval_func = self._target_eval_func if isinstance(self._executor, ThreadPoolExecutor) else None
+
+        chunks = np.array_split([move.to_label for move in moves], min(self._num_workers, len(moves)))
+        futures = [self._executor.submit(
+            _evaluate_candidates, target_eval_func, self._state.labels, component, chunk.tolist(), context)
+            for chunk in chunks]
+        values = []
+        for future in futures:
+            values.extend(future.result())
+        return values
+
+    def _batch_delta_log_target(self, state, moves, context):
+        """Score the moves one by one, for models without batch_target_eval."""
+        return np.array([self._model.delta_log_target(move, state, context) for move in moves], dtype=np.float64)
+
+    def _calculate_posteriors(self, candidates):
+        """Posterior probability of each candidate by mpmath."""
         posteriors = []
         denominator = mpmath.mpf(0.0)
-        for (candidate, cut_set) in candidates:
+        values = self._evaluate_targets([move for (move, cut_set) in candidates])
+        for ((move, cut_set), value) in zip(candidates, values):
             # This weighted posterior guarantees the detailed balance.
             weight = mpmath.mpf(1.0)
-            for (s, t) in cut_set:
-                weight *= (1 - self._edge_on_probability(s, t))
-            val = mpmath.mpf(self._target_eval_func(candidate, self.context))
+            for edge_id in cut_set:
+                weight *= (1 - self._edge_on_probability(edge_id))
+            val = mpmath.mpf(value)
             posterior = weight * val
 
             posteriors.append(posterior)
@@ -301,16 +1586,162 @@ class _SWCuts(object):
 
         # Normalize the posterior probability.
         assert(denominator != 0)
-        posteriors = [p/denominator for p in posteriors]
+        return np.array([float(p/denominator) for p in posteriors])
+
+    def _calculate_log_space_posteriors(self, candidates):
+        """Posterior probability of each candidate, normalized by
+        log-sum-exp in float64."""
+        log_posteriors = np.empty(len(candidates))
+        for (i, (move, cut_set)) in enumerate(candidates):
+            # This weighted posterior guarantees the detailed balance.
+            log_posteriors[i] = self._cut_log_weight(cut_set)
+        if self._model is not None:
+            log_posteriors += self._batch_target_eval(self._state, [move for (move, cut_set) in candidates], self.context)
+        else:
+            values = self._evaluate_targets([move for (move, cut_set) in candidates])
+            log_posteriors += np.array([float(value) for value in values])
+
+        max_log_posterior = np.max(log_posteriors)
+        assert(np.isfinite(max_log_posterior))
+        posteriors = np.exp(log_posteriors - max_log_posterior)
+        return posteriors / np.sum(posteriors)
+
+    def _flip_connected_component(self, component):
+        stats = self.context.stats
+        start = time.perf_counter()
+        candidates = self._generate_candidates(component)
+        evaluation_start = time.perf_counter()
+        stats.add_time('candidate_generation', evaluation_start - start)
+
+        # Calculate the posterior probability of each candidate.
+        if self._log_target or self._model is not None:
+            posteriors = self._calculate_log_space_posteriors(candidates)
+        else:
+            posteriors = self._calculate_posteriors(candidates)
+        selection_start = time.perf_counter()
+        stats.add_time('target_evaluation', selection_start - evaluation_start)
 
-        print('Component: {0}'.format(component))
-        print('# of candidate: {0}'.format(len(candidates)))
-        print('Posteriors: {0}'.format(posteriors))
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug('Component: %s', component)
+            _logger.debug('# of candidate: %d', len(candidates))
+            _logger.debug('Posteriors: %s', posteriors)
 
         # Sample from the posterior probability.
-        cdf = [sum(posteriors[0:x]) for x in range(1, len(posteriors)+1)]
-        r = random.random()
-        for i in range(0, len(cdf)):
-            if cdf[i] > r:
-                (selected_candidate, cut_set) = candidates[i]
-                return selected_candidate
+        cdf = np.cumsum(posteriors)
+        r = self._rng.random() * cdf[-1]
+        i = min(int(np.searchsorted(cdf, r, side='right')), len(candidates) - 1)
+        (selected_move, cut_set) = candidates[i]
+        to_new_cluster = selected_move.to_label not in self._state
+        self._state.apply(selected_move)
+        if self._model is not None:
+            self._model.apply_move(selected_move, self._state, self.context)
+        stats.record_flip(len(candidates), selected_move.from_label != selected_move.to_label, to_new_cluster)
+        stats.add_time('selection', time.perf_counter() - selection_start)
+        return selected_move
+
+    def _setup_split_merge(self):
+        """The scale of the affinities exp(-distance/scale) of split-merge
+        proposals: the median distance over the edges."""
+        graph = self._adjacency_graph
+        distances = []
+        for v in range(0, graph.size):
+            neighbors = graph.indices[graph.indptr[v]:graph.indptr[v+1]]
+            neighbors = neighbors[neighbors > v]
+            if len(neighbors) > 0:
+                distances.append(np.asarray(self._distance_func(v, neighbors), dtype=np.float64))
+        scale = float(np.median(np.concatenate(distances))) if len(distances) > 0 else 0.0
+        self._split_merge_scale = scale if scale > 0 and np.isfinite(scale) else 1.0
+
+    def _distances(self, v, vertices):
+        return np.asarray(self._distance_func(v, vertices), dtype=np.float64)
+
+    def _merge_seed_log_prob(self, i, j, outside):
+        """Log probability of drawing j among the vertexes 'outside' of the
+        cluster of i, proportional to exp(-distance(i, j)/scale)."""
+        log_affinities = -self._distances(i, outside) / self._split_merge_scale
+        index = int(np.searchsorted(outside, j))
+        return log_affinities[index] - np.logaddexp.reduce(log_affinities)
+
+    def _split_seed_log_prob(self, i, j, others):
+        """Log probability of drawing j among the other members of the
+        cluster of i, proportional to distance(i, j)."""
+        distances = self._distances(i, others)
+        total = np.sum(distances)
+        if total <= 0:
+            return -math.log(len(others))
+        return math.log(distances[int(np.searchsorted(others, j))] / total)
+
+    def _allocation_log_probs(self, i, j, rest):
+        """Log probabilities of assigning each vertex of 'rest' to the side
+        of seed i, and to the side of seed j."""
+        log_affinities_i = -self._distances(i, rest) / self._split_merge_scale
+        log_affinities_j = -self._distances(j, rest) / self._split_merge_scale
+        log_normalizers = np.logaddexp(log_affinities_i, log_affinities_j)
+        return (log_affinities_i - log_normalizers, log_affinities_j - log_normalizers)
+
+    def _move_log_target_delta(self, move):
+        if self._model is not None:
+            return float(self._model.delta_log_target(move, self._state, self.context))
+        after = self._evaluate_target(move)
+        if not self._log_target:
+            after = mpmath.log(after)
+        return float(after) - self._current_log_target()
+
+    def _propose_split_merge(self):
+        """One split or merge proposal seeded by a random vertex i, accepted
+        with the Metropolis-Hastings probability. The reverse proposal is
+        the opposite move with the same seeds. Returns the accepted move,
+        or None."""
+        state = self._state
+        i = int(self._rng.integers(state.size))
+        label = int(state.label_of(i))
+        members = state.members(label)
+        split = self._rng.random() < 0.5
+
+        if split:
+            if len(members) == 1:
+                return None
+            others = np.array(sorted(members - {i}), dtype=np.int64)
+            distances = self._distances(i, others)
+            total = np.sum(distances)
+            p = distances / total if total > 0 else None
+            index = self._rng.choice(len(others), p=p)
+            j = int(others[index])
+            rest = others[others != j]
+            (log_probs_i, log_probs_j) = self._allocation_log_probs(i, j, rest)
+            to_j = self._rng.random(len(rest)) >= np.exp(log_probs_i)
+            log_proposal = math.log(p[index]) if p is not None else -math.log(len(others))
+            log_proposal += np.sum(log_probs_i[~to_j]) + np.sum(log_probs_j[to_j])
+            move = Move({j} | set(rest[to_j].tolist()), label, state.peek_free_label())
+            # In reverse, j is drawn outside of the remaining cluster of i.
+            outside = np.flatnonzero(state.labels != label)
+            outside = np.union1d(outside, np.fromiter(move.component, dtype=np.int64, count=len(move.component)))
+            log_reverse = self._merge_seed_log_prob(i, j, outside)
+        else:
+            outside = np.flatnonzero(state.labels != label)
+            if len(outside) == 0:
+                return None
+            log_affinities = -self._distances(i, outside) / self._split_merge_scale
+            p = np.exp(log_affinities - np.max(log_affinities))
+            index = self._rng.choice(len(outside), p=p / np.sum(p))
+            j = int(outside[index])
+            other_label = int(state.label_of(j))
+            log_proposal = log_affinities[index] - np.logaddexp.reduce(log_affinities)
+            move = Move(set(state.members(other_label)), other_label, label)
+            # In reverse, the merged cluster is split by the seeds i and j.
+            others = np.array(sorted((members | move.component) - {i}), dtype=np.int64)
+            rest = others[others != j]
+            (log_probs_i, log_probs_j) = self._allocation_log_probs(i, j, rest)
+            in_component = np.fromiter((v in move.component for v in rest.tolist()), dtype=bool, count=len(rest))
+            log_reverse = (self._split_seed_log_prob(i, j, others)
+                           + np.sum(log_probs_i[~in_component]) + np.sum(log_probs_j[in_component]))
+
+        log_acceptance = self._move_log_target_delta(move) + log_reverse - log_proposal
+        accepted = log_acceptance >= 0 or self._rng.random() < math.exp(log_acceptance)
+        self.context.stats.record_split_merge(split, accepted)
+        if not accepted:
+            return None
+        self._state.apply(move)
+        if self._model is not None:
+            self._model.apply_move(move, self._state, self.context)
+        return move
@@ -0,0 +1,66 @@
+class GraphBuilder(object):
+    """Build a graph edge by edge, keeping the number of nodes and edges of
+    every connected component in a union-find. An edge is admitted unless
+    its component would have more than twice as many edges as nodes, i.e.
+        edges - nodes > nodes
+    as judged by graph_cycle.judge_cycle(). Each edge costs near-constant
+    time. Nodes count once they are the end point of an edge.
+    Counts are kept in plain lists, which are faster than NumPy arrays
+    for one element at a time."""
+    def __init__(self, size):
+        self.edges = []
+        self._parents = list(range(size))
+        self._num_nodes = [1] * size
+        self._num_edges = [0] * size
+
+    def __len__(self):
+        return len(self.edges)
+
+    def find(self, v):
+        """Root of the component of v, halving the path on the way."""
+        parents = self._parents
+        while parents[v] != v:
+            parents[v] = parents[parents[v]]
+            v = parents[v]
+        return v
+
+    def component_size(self, v):
+        """(nodes, edges) of the component of v."""
+        root = self.find(v)
+        return (self._num_nodes[root], self._num_edges[root])
+
+    def add_edge(self, s, t):
+        """Add edge (s, t) unconditionally."""
+        self._add(self.find(s), self.find(t))
+        self.edges.append((s, t))
+
+    def try_add_edge(self, s, t):
+        """Add edge (s, t) if its component stays within the rule.
+        Returns whether the edge was added."""
+        (root_s, root_t) = (self.find(s), self.find(t))
+        num_nodes = self._num_nodes[root_s]
+        num_edges = self._num_edges[root_s] + 1
+        if root_s != root_t:
+            num_nodes += self._num_nodes[root_t]
+            num_edges += self._num_edges[root_t]
+        if num_edges - num_nodes > num_nodes:
+            return False
+        self._add(root_s, root_t)
+        self.edges.append((s, t))
+        return True
+
+    def is_within_rule(self):
+        """Whether every component has edges - nodes <= nodes."""
+        return all(self._num_edges[v] - self._num_nodes[v] <= self._num_nodes[v]
+                   for v in range(len(self._parents)) if self._parents[v] == v)
+
+    def _add(self, root_s, root_t):
+        if root_s == root_t:
+            self._num_edges[root_s] += 1
+            return
+        # Union by size.
+        if self._num_nodes[root_s] < self._num_nodes[root_t]:
+            (root_s, root_t) = (root_t, root_s)
+        self._parents[root_t] = root_s
+        self._num_nodes[root_s] += self._num_nodes[root_t]
+        self._num_edges[root_s] += self._num_edges[root_t] + 1
@@ -1,6 +1,7 @@
-import networkx as nx
 import logging
 
+from model.graph_builder import GraphBuilder
+
 class graph_edge(object):
     def __init__(self, i, j, value):
         self.cor_i = i
@@ -14,15 +15,17 @@ def judge_cycle(edgelist):
     """Judge if more than one cycle exist in one graph constructed by the given edges"""
     if len(edgelist) == 1:
         return 0
-    g = nx.Graph()
-    g.add_edges_from(edgelist)
-    sub_g = nx.connected_component_subgraphs(g)
-    for sg in sub_g:
-        num_nodes = len(sg.nodes())
-        num_edges = len(sg.edges())
-        dif = num_edges - num_nodes
-        #logging.debug('Edges: {0}'.format(sg.edges()))
-        #logging.debug('Dif: {0}'.format(dif))
-        if  dif > num_nodes:
-            return 1
-    return 0
\ No newline at end of file
+    # Repeated edges count once, as in a simple graph.
+    node_ids = dict()
+    unique_edges = set()
+    for (s, t) in edgelist:
+        node_ids.setdefault(s, len(node_ids))
+        node_ids.setdefault(t, len(node_ids))
+        unique_edges.add(frozenset((node_ids[s], node_ids[t])))
+    builder = GraphBuilder(len(node_ids))
+    for e in unique_edges:
+        (s, t) = tuple(e) if len(e) == 2 else tuple(e) * 2
+        builder.add_edge(s, t)
+    if builder.is_within_rule():
+        return 0
+    return 1
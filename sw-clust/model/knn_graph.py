@@ -0,0 +1,143 @@
+"""
+Approximate k-nearest-neighbor graphs under the symmetric KL divergence.
+
+Usage:
+        from model import knn_graph, probability
+        kl = probability.SymmetricKL(matrix)
+        (edges, distances) = knn_graph.knn_graph(kl, k=3, candidates='inverted_index')
+
+    Candidate neighbors of every vertex are generated from the sparse
+    support of its histogram only, either
+        'inverted_index': vertexes sharing some of its top-weighted words,
+                          ranked by the product of the top-word weights, or
+        'minhash':        vertexes falling into the same bucket in some band
+                          of MinHash signatures of the top-word sets, ranked
+                          by the number of shared bands.
+    The best 'max_candidates' of every vertex are re-ranked by the exact
+    symmetric KL divergence, and the k nearest make the edges. The cost
+    grows with the number of vertexes times the candidates, not with the
+    number of vertex pairs.
+"""
+
+import numpy as np
+from scipy.sparse import coo_matrix, csr_matrix
+
+
+def top_word_matrix(matrix, num_words):
+    """Copy of the sparse 'matrix' keeping the 'num_words' largest entries
+    of every row."""
+    matrix = csr_matrix(matrix)
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+    keep = _ranks_within(rows, -matrix.data) < num_words
+    return csr_matrix((matrix.data[keep], (rows[keep], matrix.indices[keep])), shape=matrix.shape)
+
+
+def _ranks_within(groups, values):
+    """Rank of every value within its group, in ascending order."""
+    order = np.lexsort((values, groups))
+    sorted_groups = groups[order]
+    starts = np.flatnonzero(np.concatenate([[True], sorted_groups[1:] != sorted_groups[:-1]]))
+    first = np.repeat(starts, np.diff(np.concatenate([starts, [len(groups)]])))
+    ranks = np.empty(len(groups), dtype=np.int64)
+    ranks[order] = np.arange(len(groups)) - first
+    return ranks
+
+
+def _best_per_row(rows, columns, scores, limit):
+    """The (rows, columns) of the 'limit' highest scores of every row."""
+    keep = _ranks_within(rows, -scores) < limit
+    return (rows[keep], columns[keep])
+
+
+def inverted_index_candidates(matrix, max_candidates, num_words=20, max_postings=1000, block_size=4096):
+    """Candidate pairs (sources, targets) of vertexes sharing top words.
+    Only the 'max_postings' heaviest vertexes of a word are indexed, so that
+    frequent words do not make every vertex a candidate."""
+    top_words = top_word_matrix(matrix, num_words).tocoo()
+    keep = _ranks_within(top_words.col, -top_words.data) < max_postings
+    top_words = csr_matrix((top_words.data[keep], (top_words.row[keep], top_words.col[keep])), shape=top_words.shape)
+    postings = top_words.T.tocsr()
+
+    sources = []
+    targets = []
+    for start in range(0, top_words.shape[0], block_size):
+        scores = top_words[start:start + block_size].dot(postings).tocoo()
+        rows = scores.row + start
+        others = rows != scores.col
+        (rows, columns) = _best_per_row(rows[others], scores.col[others], scores.data[others], max_candidates)
+        sources.append(rows)
+        targets.append(columns)
+    return (np.concatenate(sources), np.concatenate(targets))
+
+
+def minhash_candidates(matrix, max_candidates, num_words=20, num_bands=32, band_size=1, max_bucket=200, seed=0):
+    """Candidate pairs (sources, targets) of vertexes whose top-word sets
+    share a bucket in some band of 'band_size' MinHash values. Buckets of
+    more than 'max_bucket' vertexes are skipped."""
+    top_words = top_word_matrix(matrix, num_words)
+    size = top_words.shape[0]
+    (indptr, indices) = (top_words.indptr, top_words.indices.astype(np.int64))
+    nonempty = np.diff(indptr) > 0
+
+    # Universal hashing (a * word + b) mod prime, one function per value.
+    prime = (1 << 31) - 1
+    rng = np.random.default_rng(seed)
+    num_hashes = num_bands * band_size
+    coefficients = rng.integers(1, prime, size=num_hashes)
+    intercepts = rng.integers(0, prime, size=num_hashes)
+    signatures = np.empty((size, num_hashes), dtype=np.int64)
+    # Vertexes without words share no bucket.
+    signatures[~nonempty] = prime + np.flatnonzero(~nonempty)[:, np.newaxis]
+    if np.any(nonempty):
+        for h in range(0, num_hashes):
+            values = (coefficients[h] * indices + intercepts[h]) % prime
+            signatures[nonempty, h] = np.minimum.reduceat(values, indptr[:-1][nonempty])
+
+    # Score = number of bands shared, summed band by band.
+    scores = csr_matrix((size, size), dtype=np.float64)
+    for band in range(0, num_bands):
+        keys = signatures[:, band*band_size:(band + 1)*band_size]
+        (unused, buckets) = np.unique(keys, axis=0, return_inverse=True)
+        (sources, targets) = _bucket_pairs(buckets.ravel(), max_bucket)
+        others = sources != targets
+        scores = scores + coo_matrix(
+            (np.ones(np.count_nonzero(others)), (sources[others], targets[others])), shape=(size, size)).tocsr()
+    scores = scores.tocoo()
+    return _best_per_row(scores.row.astype(np.int64), scores.col.astype(np.int64), scores.data, max_candidates)
+
+
+def _bucket_pairs(buckets, max_bucket):
+    """All ordered pairs (sources, targets) of vertexes in the same bucket,
+    for the buckets of 2 to 'max_bucket' vertexes."""
+    order = np.argsort(buckets, kind='stable')
+    sizes = np.bincount(buckets)
+    starts = np.concatenate([[0], np.cumsum(sizes)])[:-1]
+    kept = order[(sizes[buckets[order]] >= 2) & (sizes[buckets[order]] <= max_bucket)]
+    kept_sizes = sizes[buckets[kept]]
+    kept_starts = starts[buckets[kept]]
+    # Every kept vertex is paired with each vertex of its bucket in turn.
+    sources = np.repeat(kept, kept_sizes)
+    first = np.repeat(np.cumsum(kept_sizes) - kept_sizes, kept_sizes)
+    targets = order[np.repeat(kept_starts, kept_sizes) + np.arange(len(sources)) - first]
+    return (sources, targets)
+
+
+CANDIDATES = {
+    'inverted_index': inverted_index_candidates,
+    'minhash': minhash_candidates}
+
+
+def knn_graph(kl, k=3, candidates='inverted_index', max_candidates=50, **options):
+    """Edges (s, t), s < t, joining every vertex to its k nearest candidates
+    by the exact divergence of 'kl' (a probability.SymmetricKL), as an
+    array of shape (m, 2) in lexicographic order, with their divergences.
+    'options' are passed to the candidate generator."""
+    if candidates not in CANDIDATES:
+        raise ValueError('Unknown candidate generator: {0}'.format(candidates))
+    (sources, targets) = CANDIDATES[candidates](kl.matrix, max_candidates, **options)
+    distances = kl.pairs(sources, targets)
+    keep = _ranks_within(sources, distances) < k
+
+    pairs = np.sort(np.stack([sources[keep], targets[keep]], axis=1), axis=1)
+    (edges, first) = np.unique(pairs, axis=0, return_index=True)
+    return (edges.reshape(-1, 2), distances[keep][first])
@@ -1,6 +1,13 @@
 # Probability
 import numpy as np
 import mpmath
+from scipy.sparse import csr_matrix
+
+
+# Distribution.kl_divergence() smooths both sides by this value.
+_KL_EPSILON = 1e-100
+# Log-likelihoods smooth the probabilities by this value by default.
+_LOG_EPSILON = 1e-100
 
 
 class Distribution(object):
@@ -20,6 +27,9 @@ class Distribution(object):
         if self._denominator != 1 and self._denominator != 0:
             self._hist /= self._denominator
 
+    def __len__(self):
+        return self._length
+
     def __contains__(self, word_id):
         return (0 <= word_id < self._length)
 
@@ -29,10 +39,34 @@ class Distribution(object):
         else:
             raise ValueError('The distribution is empty.')
 
+    def probabilities(self):
+        """The normalized histogram."""
+        if self._hist is not None:
+            return self._hist
+        else:
+            raise ValueError('The distribution is empty.')
+
+    def support(self, counts=False):
+        """(word_ids, values) of the nonzero entries in ascending word id,
+        with values the probabilities, or the counts if 'counts'."""
+        hist = np.asarray(self.probabilities(), dtype=np.float64)
+        word_ids = np.flatnonzero(hist)
+        values = hist[word_ids]
+        if counts:
+            values = values * self._denominator
+        return (word_ids, values)
+
+    def counts(self):
+        """Recover the histogram of counts."""
+        if self._hist is not None:
+            return self._hist * self._denominator
+        else:
+            raise ValueError('The distribution is empty.')
+
     def __add__(self, other):
         # Recover histogram and add.
         if self._hist is not None:
-            new_hist = self._hist * self._denominator + other._hist * other._denominator
+            new_hist = self._hist * self._denominator + other.counts()
             return Distribution(new_hist)
         else:
             return other
@@ -46,18 +80,24 @@ class Distribution(object):
 
     def kl_divergence(self, other):
         p = self._hist
-        q = other._hist
+        q = other.probabilities()
         assert(self._length == other._length)
         #kl_array = [p[i]*(mpmath.log(p[i] + 1e-100) - mpmath.log(q[i] + 1e-100)) for i in range(0, self._length)]
-        kl_array = p*np.log((p + 1e-100)/(q + 1e-100))
+        kl_array = p*np.log((p + _KL_EPSILON)/(q + _KL_EPSILON))
         kl_value = sum(kl_array)
         return kl_value
 
     def tv_norm(self, other):
         assert(self._length == other._length)
-        diff = np.absolute(self._hist - other._hist)
+        diff = np.absolute(self._hist - other.probabilities())
         return mpmath.mpf(np.sum(diff))/2.0
 
+    def log_likelihood(self, word_ids, counts, smoothing=_LOG_EPSILON):
+        """sum(counts * log(p[word_ids] + smoothing)), the log-likelihood of
+        observing word word_ids[k] counts[k] times."""
+        p = self.probabilities()[np.asarray(word_ids, dtype=np.int64)]
+        return float(np.dot(counts, np.log(p + smoothing)))
+
     def combine(self, other):
         self = self.__add__(other)
 
@@ -69,6 +109,237 @@ class Distribution(object):
         return filtered_id
 
 
+class SparseDistribution(object):
+    """A 1D histogram (normalized to 1) stored as the sorted word ids of its
+    nonzero entries and their probabilities, among 'length' word ids.
+    Supports the operations of Distribution, at a cost in the size of the
+    support instead of 'length'."""
+    def __init__(self, word_ids=None, counts=None, length=0):
+        """Histogram of 'counts' at 'word_ids', where repeated word ids add
+        up; counts default to 1 per word id (e.g. the word ids of a document)."""
+        if word_ids is None:
+            word_ids = []
+        word_ids = np.asarray(word_ids, dtype=np.int64)
+        if counts is None:
+            counts = np.ones(len(word_ids))
+        (unique_word_ids, inverse) = np.unique(word_ids, return_inverse=True)
+        if len(unique_word_ids) > 0 and (unique_word_ids[0] < 0 or unique_word_ids[-1] >= length):
+            raise ValueError('Word ids shall be in [0, {0}).'.format(length))
+        self._length = length
+        self._set_support(unique_word_ids, np.bincount(inverse.ravel(), weights=counts, minlength=len(unique_word_ids)))
+
+    def _set_support(self, word_ids, counts):
+        """Set the histogram from the counts at the sorted distinct 'word_ids'."""
+        nonzero = counts != 0
+        self._word_ids = word_ids[nonzero]
+        values = counts[nonzero]
+        self._denominator = values.sum()
+        if self._denominator != 1 and self._denominator != 0:
+            values /= self._denominator
+        self._values = values
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, word_id):
+        return (0 <= word_id < self._length)
+
+    def __getitem__(self, word_id):
+        position = np.searchsorted(self._word_ids, word_id)
+        if position < len(self._word_ids) and self._word_ids[position] == word_id:
+            return self._values[position]
+        return 0.0
+
+    def probabilities(self):
+        """The normalized histogram, as a dense array."""
+        hist = np.zeros(self._length)
+        hist[self._word_ids] = self._values
+        return hist
+
+    def counts(self):
+        """Recover the histogram of counts, as a dense array."""
+        return self.probabilities() * self._denominator
+
+    def support(self, counts=False):
+        """(word_ids, values) of the nonzero entries in ascending word id,
+        with values the probabilities, or the counts if 'counts'."""
+        if counts:
+            return (self._word_ids, self._values * self._denominator)
+        return (self._word_ids, self._values)
+
+    def __add__(self, other):
+        """Distribution of the summed counts. Empty supports are allowed,
+        e.g. documents without words of some word type:
+
+        >>> empty = SparseDistribution([], length=5)
+        >>> len((empty + empty).support()[0])
+        0
+        >>> (empty + SparseDistribution([1, 3, 3], length=5)).support(counts=True)
+        (array([1, 3]), array([1., 2.]))
+        """
+        if not isinstance(other, SparseDistribution):
+            return other.__add__(self)
+        if self._length == 0:
+            return other
+        assert(self._length == other._length)
+        # Merge the sorted supports; a stable sort of two sorted runs is linear.
+        word_ids = np.concatenate([self._word_ids, other._word_ids])
+        counts = np.concatenate([self._values * self._denominator, other._values * other._denominator])
+        result = SparseDistribution(length=self._length)
+        if len(word_ids) == 0:
+            return result
+        order = np.argsort(word_ids, kind='stable')
+        (word_ids, counts) = (word_ids[order], counts[order])
+        starts = np.flatnonzero(np.concatenate([[True], word_ids[1:] != word_ids[:-1]]))
+        result._set_support(word_ids[starts], np.add.reduceat(counts, starts))
+        return result
+
+    def __radd__(self, other):
+        return self.__add__(other)
+
+    def __iadd__(self, other):
+        return self.__add__(other)
+
+    def kl_divergence(self, other):
+        assert(self._length == other._length)
+        # Terms off the support of self vanish.
+        (other_word_ids, other_values) = other.support()
+        q = _values_at(other_word_ids, other_values, self._word_ids)
+        p = self._values
+        return np.sum(p*np.log((p + _KL_EPSILON)/(q + _KL_EPSILON)))
+
+    def tv_norm(self, other):
+        assert(self._length == other._length)
+        (other_word_ids, other_values) = other.support()
+        q = _values_at(other_word_ids, other_values, self._word_ids)
+        # Mass of other off the support of self.
+        outside = np.sum(other_values) - np.sum(q)
+        return mpmath.mpf(np.sum(np.absolute(self._values - q)) + outside)/2.0
+
+    def log_likelihood(self, word_ids, counts, smoothing=_LOG_EPSILON):
+        """sum(counts * log(p[word_ids] + smoothing)), the log-likelihood of
+        observing word word_ids[k] counts[k] times."""
+        p = _values_at(self._word_ids, self._values, np.asarray(word_ids, dtype=np.int64))
+        return float(np.dot(counts, np.log(p + smoothing)))
+
+    def combine(self, other):
+        self = self.__add__(other)
+
+    def get_top_word_ids(self, num_words):
+        """Synthesize a set of words from the distribution."""
+        order = np.argsort(self._values, kind='stable')[::-1]
+        return self._word_ids[order[0:min(num_words, len(order))]].tolist()
+
+
+def _values_at(word_ids, values, queries):
+    """Value at each of the 'queries', 0 for those not among the sorted
+    'word_ids'."""
+    result = np.zeros(len(queries))
+    if len(word_ids) == 0:
+        return result
+    positions = np.minimum(np.searchsorted(word_ids, queries), len(word_ids) - 1)
+    found = word_ids[positions] == queries
+    result[found] = values[positions[found]]
+    return result
+
+
+def count_log_likelihoods(counts, smoothing=_LOG_EPSILON):
+    """Log-likelihood of every row of the sparse count matrix 'counts' under
+    its own normalized histogram, sum(c * log(c / total + smoothing)), as
+    an array."""
+    counts = csr_matrix(counts, dtype=np.float64)
+    counts.sum_duplicates()
+    totals = np.asarray(counts.sum(axis=1)).ravel()
+    rows = np.repeat(np.arange(counts.shape[0]), np.diff(counts.indptr))
+    log_probs = np.log(counts.data / totals[rows] + smoothing)
+    return np.bincount(rows, weights=counts.data * log_probs, minlength=counts.shape[0])
+
+
+def distribution_matrix(distributions):
+    """Sparse matrix (CSR) with the normalized histograms of
+    'distributions' (Distribution or SparseDistribution) as rows."""
+    indptr = [0]
+    indices = []
+    data = []
+    length = 0
+    for distribution in distributions:
+        (ids, values) = distribution.support()
+        indices.append(ids)
+        data.append(values)
+        indptr.append(indptr[-1] + len(ids))
+        length = len(distribution)
+    if len(indices) == 0:
+        return csr_matrix((0, 0))
+    return csr_matrix((np.concatenate(data), np.concatenate(indices), indptr), shape=(len(indptr) - 1, length))
+
+
+class SymmetricKL(object):
+    """(KL(i, j) + KL(j, i)) / 2 between rows of a sparse histogram matrix,
+    as smoothed by Distribution.kl_divergence(). Rows of several histograms
+    joined side by side give the sum of their divergences.
+
+    With log(q + eps) = log(eps) + r(q), where r vanishes off the support of q,
+        KL(i, j) = sum(p_i * log(p_i + eps)) - log(eps) * sum(p_i) - p_i . r(p_j)
+    so only the supports of the rows are visited. The per-row terms and r
+    are computed once."""
+    def __init__(self, matrix):
+        self.matrix = csr_matrix(matrix, dtype=np.float64)
+        log_epsilon = np.log(_KL_EPSILON)
+        self._residuals = self.matrix.copy()
+        self._residuals.data = np.log(self.matrix.data + _KL_EPSILON) - log_epsilon
+        log_terms = self.matrix.copy()
+        log_terms.data = self.matrix.data * np.log(self.matrix.data + _KL_EPSILON)
+        self._offsets = np.asarray(log_terms.sum(axis=1)).ravel() - log_epsilon * np.asarray(self.matrix.sum(axis=1)).ravel()
+        self._transposed = None
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    def pairs(self, sources, targets, chunk_size=65536):
+        """Divergences between rows sources[k] and targets[k], as an array."""
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        result = self._offsets[sources] + self._offsets[targets]
+        for start in range(0, len(sources), chunk_size):
+            s = sources[start:start + chunk_size]
+            t = targets[start:start + chunk_size]
+            cross = self.matrix[s].multiply(self._residuals[t]).sum(axis=1)
+            cross += self._residuals[s].multiply(self.matrix[t]).sum(axis=1)
+            result[start:start + chunk_size] -= np.asarray(cross).ravel()
+        result /= 2
+        result[sources == targets] = 0
+        return result
+
+    def rows(self, start, stop):
+        """Divergences between rows start..stop-1 and all rows, as a dense
+        block computed by two sparse products."""
+        if self._transposed is None:
+            self._transposed = (self.matrix.T.tocsr(), self._residuals.T.tocsr())
+        (matrix_transposed, residuals_transposed) = self._transposed
+        block = self._offsets[start:stop, np.newaxis] + self._offsets[np.newaxis, :]
+        block -= (self.matrix[start:stop].dot(residuals_transposed)).toarray()
+        block -= (self._residuals[start:stop].dot(matrix_transposed)).toarray()
+        block /= 2
+        # Rounding would leave tiny values on the diagonal.
+        block[np.arange(stop - start), np.arange(start, stop)] = 0
+        return block
+
+
+def symmetric_kl_matrix(matrix, block_size=1024, dtype=np.float64, out=None):
+    """SymmetricKL between all rows of 'matrix'. Blocks of 'block_size' rows
+    are computed in float64 and stored as 'dtype' in 'out' (e.g. a
+    memory-mapped array) or a new array. Memory beyond the result is
+    bounded by the block."""
+    kl = SymmetricKL(matrix)
+    size = len(kl)
+    if out is None:
+        out = np.empty((size, size), dtype=dtype)
+    for start in range(0, size, block_size):
+        stop = min(start + block_size, size)
+        out[start:stop] = kl.rows(start, stop)
+    return out
+
+
 class Probability(object):
     def __init__(self, nrow, ncol):
         self._row_num = nrow
@@ -4,19 +4,27 @@ from collections import defaultdict
 import mpmath
 
 from model import *
+from algorithm import sw
+from algorithm import cooling
 
 
-class SegmentationModel(object):
-    def __init__(self, all_sentences, transprob, length_prior, seg_num_prior, classifier):
+class SegmentationModel(sw.ClusterEnergyModel):
+    def __init__(self, all_sentences, transprob, length_prior, seg_num_prior, classifier, cooling='linear', cooling_options=None):
+        """'cooling' names the cooling schedule in algorithm.cooling.SCHEDULES,
+        created with 'cooling_options' by make_cooling_schedule()."""
         self.all_sentences = all_sentences
         self.transition_prob = transprob
         self.length_prior = length_prior
         self.seg_num_prior = seg_num_prior
         self.classifier = classifier
+        self.cooling = cooling
+        self.cooling_options = dict(cooling_options or {})
 
         self._segment_classification_cache = dict()
 
     def calculate_Qe(self, left, right, context):
+        """Depends on the sentences only, so it may be tabulated once
+        by sw.sample(..., static_edge_probs=True)."""
         right_node = self.all_sentences[right]
         if right_node.pronoun:
             # If the beginning of the right node is pronoun, turn on the edge
@@ -34,40 +42,65 @@ class SegmentationModel(object):
             temperature = 0.1
         return temperature
 
+    def make_cooling_schedule(self):
+        """The cooling schedule for sw.sample(). 'linear' keeps cooling_schedule()."""
+        options = dict(start=1000)
+        if self.cooling == 'linear':
+            options.update(period=2, step=10)
+        options.update(self.cooling_options)
+        return cooling.make_schedule(self.cooling, **options)
+
     def target_evaluation_func(self, current_clustering, context=None):
         #print(current_labeling)
         energy = self.calculate_energy(current_clustering)
         temperature = 1000
         #print(energy)
         if context is not None:
-            temperature = self.cooling_schedule(context.iteration_counter)
+            temperature = self._current_temperature(context)
         return mpmath.exp(-(energy/temperature))
 
+    def log_target_evaluation_func(self, current_clustering, context=None):
+        energy = self.calculate_energy(current_clustering)
+        temperature = 1000
+        if context is not None:
+            temperature = self._current_temperature(context)
+        return float(-(energy/temperature))
+
     def calculate_energy(self, current_clustering):
         """Energy Function: Category Posterior + Category Transition + Length Prior(Currently not included)"""
         energy = 0.0
-        previous_category = -1
+        #previous_category = -1
 
         for segment in current_clustering:
-            # likelihood term (cache to prevent repeat computation)
-            (category, prob) = self._classification(segment)
-            if prob == 0:
-                prob = 1e-100
-            energy += -mpmath.log(prob)
+            energy += self.cluster_energy(segment)
 
             # transition prob
             #if previous_category != -1:
             #    energy += -mpmath.log(self.transition_prob.get_value(category, previous_category) + 1e-100)
-            previous_category = category
+            #previous_category = category
 
-            # prior on the length of each segments
-            energy += -mpmath.log(self.length_prior[len(segment) - 1])
+        energy += self.num_clusters_energy(len(current_clustering))
 
-        # prior on number of segments
-        energy += -mpmath.log(self.seg_num_prior[len(current_clustering)])
+        return energy
+
+    def cluster_energy(self, segment):
+        # likelihood term (cache to prevent repeat computation)
+        (category, prob) = self._classification(segment)
+        if prob == 0:
+            prob = 1e-100
+        energy = -mpmath.log(prob)
 
+        # prior on the length of each segments
+        energy += -mpmath.log(self.length_prior[len(segment) - 1])
         return energy
 
+    def num_clusters_energy(self, num_clusters):
+        # prior on number of segments
+        return -mpmath.log(self.seg_num_prior[num_clusters])
+
+    def temperature(self, context):
+        return self.cooling_schedule(context.iteration_counter)
+
     def _segment_key(self, segment):
         l = list(segment)
         l.sort()
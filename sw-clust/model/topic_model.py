@@ -1,4 +1,8 @@
 import sys
+import os
+import hashlib
+import json
+import math
 import logging
 import pickle
 from collections import defaultdict
@@ -7,21 +11,27 @@ sys.path.append('..')
 
 import numpy as np
 import mpmath
+from scipy import sparse
+from scipy.sparse import csr_matrix
 from scipy.stats import norm
 import matplotlib.pyplot as plt
 
 from model import *
 from model import word_similarity
 from model.classifier import Classifier
-from model.probability import Distribution
+from model import probability
+from model.probability import SparseDistribution
 from preprocessing import vocabulary
 from algorithm import sw
-from model import graph_cycle
-from model.graph_cycle import graph_edge
+from algorithm import cooling
+from model import knn_graph
+from model.graph_builder import GraphBuilder
 
 
 class _Plotter(object):
-    def __init__(self, sw_config, ground_truth=None):
+    def __init__(self, sw_config, ground_truth=None, interval=10):
+        """Plot the energy and the temperature every 'interval' iterations."""
+        self.interval = interval
         self.iterations = []
         self.energies = []
         self.temperatures = []
@@ -42,6 +52,8 @@ class _Plotter(object):
             self._ground_truth_val = self._sw_config.energy(self.ground_truth)
 
     def plot_callback(self, clustering, context):
+        if context.iteration_counter % self.interval != 0:
+            return
         for cluster in clustering:
             for v in cluster:
                 for doc_id in self._sw_config.vertex_distributions[v].document_ids:
@@ -50,9 +62,9 @@ class _Plotter(object):
 
         self.iterations.append(context.iteration_counter)
         logging.debug('>>>')
-        self.energies.append(self._sw_config.energy(clustering))
+        self.energies.append(self._sw_config.sampler_energy(clustering))
         logging.debug('<<<')
-        self.temperatures.append(self._sw_config.cooling_schedule(context.iteration_counter))
+        self.temperatures.append(self._sw_config._current_temperature(context))
 
         # energy plot
         self.energy_plot.clear()
@@ -74,20 +86,46 @@ class _Plotter(object):
         self.fig.savefig(filename, transparent=False, bbox_inches=None, pad_inches=0.1)
 
 
-class SWConfig(object):
+class SWConfig(sw.ClusterEnergyModel):
     """One shall inherit this class to give more specific configurations."""
-    def __init__(self, graph_size, vertex_distributions, documents, vocabularies, level):
+    # The symmetric KL matrix between vertexes is stored as kl_dtype, and
+    # computed by blocks of kl_block_size rows.
+    kl_dtype = np.float64
+    kl_block_size = 1024
+    # The log-likelihood of a cluster smooths the word probabilities by
+    # likelihood_smoothing, and averages the word types with weights
+    # likelihood_weights (indexed by word type).
+    likelihood_smoothing = 1e-100
+    likelihood_weights = (1.0,)*NUM_WORD_TYPE
+
+    def __init__(self, graph_size, vertex_distributions, documents, vocabularies, level, cooling='linear', cooling_options=None, graph='all_pairs', graph_options=None):
+        """'cooling' names the cooling schedule in algorithm.cooling.SCHEDULES,
+        created with 'cooling_options' by make_cooling_schedule().
+        'graph' selects how the edges are built:
+            'all_pairs': 2n edges in ascending symmetric KL divergence among
+                         all vertex pairs, from the full divergence matrix.
+            'knn':       the approximate k-nearest-neighbor graph of
+                         knn_graph.knn_graph() with 'graph_options', which
+                         never visits all vertex pairs."""
+        if graph not in ('all_pairs', 'knn'):
+            raise ValueError('Unknown graph construction: {0}'.format(graph))
         self.graph_size = graph_size
         self.edges = []
-        self.monitor_statistics = self.energy
         self.vertex_distributions = vertex_distributions
         self.level = level
         self.documents = documents
         self.vocabularies = vocabularies
+        self.cooling = cooling
+        self.cooling_options = dict(cooling_options or {})
+        self.graph = graph
+        self.graph_options = dict(graph_options or {})
 
         # cache
         self._likelihood_cache = dict()
-        self._kl_cache = dict()
+        self._kl = None
+        self._symmetric_kl = None
+        self._vertex_word_counts = None
+        self._move_energies = dict()
 
     def setup(self):
         self.edges = self._initialize_edges()
@@ -97,103 +135,272 @@ class SWConfig(object):
 
     def _initialize_edges(self):
         """Generate the edges for the graph."""
-        edges = []
-        distance_all = []
-        for i in range(0, self.graph_size-1):
-            for j in range(i+1, self.graph_size):
-                distance = 0.0
-                distance += self._kl_divergence(i, j)
-                distance += self._kl_divergence(j, i)
-                distance /= 2
-                #distance_tv /= NUM_WORD_TYPE
-                #distance_all.append(distance)
-                distance_all.append((i, j, distance))
-        #distance_all_sort = sorted(distance_all, key=float)
-
-        #distance_threshold = distance_all_sort[self.graph_size*2]
-        #logging.debug('Distance Threshold {0}'.format(distance_threshold))
-        #count = 0
-        #for i in range(0, self.graph_size-1):
-        #    for j in range(i+1, self.graph_size):
-        #        if distance_all[count] < distance_threshold:
-        #            edges.append((i, j))
-        #        count += 1
-        distance_all_sorted = sorted(distance_all, key=lambda graph_edge: graph_edge[2])
+        if self.graph == 'knn':
+            (edges, distances) = knn_graph.knn_graph(self._vertex_kl(), **self.graph_options)
+            return [tuple(e) for e in edges.tolist()]
+
         edge_num = self.graph_size*2
-        count = 0
-        edges_tmp = []
-        for e in distance_all_sorted:
-            edges_tmp.append((e[0], e[1]))
-            if graph_cycle.judge_cycle(edges_tmp):
-                edges_tmp = list(edges)
+        # Skip edges which would give a component more than twice as many
+        # edges as nodes.
+        builder = GraphBuilder(self.graph_size)
+        for (s, t) in self._pairs_by_distance():
+            if not builder.try_add_edge(s, t):
                 continue
-            edges.append((e[0], e[1]))
-            count += 1
-            logging.debug('Add edge {0}: ({1}, {2})'.format(count, e[0], e[1]))
-            if count >= edge_num:
+            logging.debug('Add edge {0}: ({1}, {2})'.format(len(builder), s, t))
+            if len(builder) >= edge_num:
                 break
-        return edges
-
-    def _kl_key(self, s, t):
-        return '{0}, {1}'.format(s, t)
-
-    def _kl_divergence(self, s, t):
-        kl_key = self._kl_key(s, t)
-        if kl_key not in self._kl_cache:
-            self._kl_cache[kl_key] = self.vertex_distributions[s].kl_divergence(self.vertex_distributions[t])
-        return self._kl_cache[kl_key]
+        return builder.edges
+
+    def _pairs_by_distance(self, chunk_size=4096):
+        """Generate the vertex pairs (s, t), s < t, in ascending symmetric KL
+        divergence. Pairs are converted to Python in chunks."""
+        distances = self._symmetric_kl_matrix()
+        (sources, targets) = np.triu_indices(self.graph_size, 1)
+        order = np.argsort(distances[sources, targets], kind='stable')
+        for start in range(0, len(order), chunk_size):
+            chunk = order[start:start + chunk_size]
+            for pair in zip(sources[chunk].tolist(), targets[chunk].tolist()):
+                yield pair
+
+    def _vertex_kl(self):
+        """probability.SymmetricKL over the histograms of all word types of
+        every vertex joined side by side, i.e. NUM_WORD_TYPE times the
+        symmetric KL divergence of _VertexDistribution."""
+        if self._kl is None:
+            matrix = sparse.hstack([
+                probability.distribution_matrix([vertex_distribution[word_type] for vertex_distribution in self.vertex_distributions])
+                for word_type in WORD_TYPES]).tocsr()
+            self._kl = probability.SymmetricKL(matrix)
+        return self._kl
+
+    def _symmetric_kl_matrix(self):
+        """(KL(s, t) + KL(t, s)) / 2 between all vertexes, where KL is that of
+        _VertexDistribution, computed once by probability.symmetric_kl_matrix()."""
+        if self._symmetric_kl is None:
+            self._symmetric_kl = probability.symmetric_kl_matrix(self._vertex_kl().matrix, self.kl_block_size, self.kl_dtype)
+            self._symmetric_kl /= NUM_WORD_TYPE
+        return self._symmetric_kl
+
+    def _symmetric_kl_pairs(self, sources, targets):
+        """Symmetric KL divergence between vertexes sources[k] and targets[k].
+        The full matrix is only used by the 'all_pairs' graph."""
+        if self.graph == 'all_pairs':
+            return self._symmetric_kl_matrix()[sources, targets].astype(np.float64)
+        return self._vertex_kl().pairs(sources, targets) / NUM_WORD_TYPE
+
+    def vertex_distances(self, v, vertices):
+        """Symmetric KL divergence between vertex v and each of 'vertices',
+        the scores of sw.sample(split_merge_distance_func=...)."""
+        vertices = np.asarray(vertices, dtype=np.int64)
+        return self._symmetric_kl_pairs(np.full(len(vertices), v, dtype=np.int64), vertices)
 
     def edge_prob_func(self, s, t, context):
         """Calculate edge probability based on KL divergence."""
-        # Cache KL divergence between two vertexes.
-        kl_pq = self._kl_divergence(s, t)
-        kl_qp = self._kl_divergence(t, s)
-        kl_sum = kl_pq + kl_qp
+        kl_sum = 2 * float(self._symmetric_kl_pairs([s], [t])[0])
 
         #temperature = self.cooling_schedule(context.iteration_counter)
         edge_prob = mpmath.exp(-kl_sum/(2*500))
         return edge_prob
 
+    def edge_probs(self):
+        """Edge probabilities of all edges, aligned with self.edges.
+        They do not change during sampling, so they are tabulated once."""
+        edges = np.array(self.edges, dtype=np.int64).reshape(-1, 2)
+        kl_sums = 2 * self._symmetric_kl_pairs(edges[:, 0], edges[:, 1])
+        return np.exp(-kl_sums/(2*500))
+
+    def log_edge_off_func(self, s, t, context):
+        """log(1 - edge_prob_func(s, t)), computed without leaving float64."""
+        kl_sum = 2 * float(self._symmetric_kl_pairs([s], [t])[0])
+        if kl_sum <= 0:
+            return -math.inf
+        return math.log(-math.expm1(-kl_sum/(2*500)))
+
     def target_eval_func(self, clustering, context=None):
-        temperature = self.cooling_schedule(context.iteration_counter)
+        temperature = self._current_temperature(context)
         target = mpmath.exp(- self.energy(clustering) / temperature)
         return target
 
+    def log_target_eval_func(self, clustering, context=None):
+        temperature = self._current_temperature(context)
+        return float(- self.energy(clustering) / temperature)
+
+    def monitor_statistics(self, clustering):
+        return self.energy(clustering)
+
+    def sampler_energy(self, clustering):
+        """monitor_statistics of a sampler driving this model: the energy of
+        the sampler's current state 'clustering', read from the cached
+        cluster energies (see sw.ClusterEnergyModel). Use energy() for any
+        other clustering."""
+        energy = self.current_energy()
+        if energy is None:
+            energy = self.energy(clustering)
+        return energy
+
     def energy(self, clustering):
         energy = 0.0
-        new_vertex_distribution = _combine_vertex_distributions_given_clustering(
-            self.vertex_distributions, clustering)
-
-        energy += -self._log_likelihood(clustering, new_vertex_distribution)
-
-        # prior on time (for level 1 only)
-        if self.level == 1:
-            for cluster in clustering:
-                energy += -mpmath.log(self._time_prior(cluster))
+        for cluster in clustering:
+            energy += self.cluster_energy(cluster)
 
         # prior on cluster size: prefer large clusters
         #for cluster in clustering:
         #    energy += -mpmath.log(mpmath.exp(len(cluster)-len(self.vertex_distributions)))
 
-        # prior on clustering complexity: prefer small number of clusters.
-        energy += -30*mpmath.log(mpmath.exp(-len(clustering)))
+        energy += self.num_clusters_energy(len(clustering))
+        return energy
+
+    def cluster_energy(self, cluster):
+        """The energy term contributed by a single cluster."""
+        new_vertex_distribution = _combine_vertex_distributions_given_clustering(
+            self.vertex_distributions, [cluster])
+        energy = -self._log_likelihood([cluster], new_vertex_distribution)
+
+        # prior on time (for level 1 only)
+        if self.level == 1:
+            energy += -mpmath.log(self._time_prior(cluster))
         return energy
 
-    def _log_likelihood(self, clustering, new_vertex_distribution, weights=[1]*NUM_WORD_TYPE):
+    def num_clusters_energy(self, num_clusters):
+        # prior on clustering complexity: prefer small number of clusters.
+        return -30*mpmath.log(mpmath.exp(-num_clusters))
+
+    def temperature(self, context):
+        return self.cooling_schedule(context.iteration_counter)
+
+    def reset(self, state, context):
+        super(SWConfig, self).reset(state, context)
+        self._move_energies = dict()
+
+    def delta_log_target(self, move, state, context):
+        return float(self.batch_target_eval(state, [move], context)[0])
+
+    def apply_move(self, move, state, context):
+        """Take the energies of the changed clusters from the last
+        batch_target_eval() when it scored this move."""
+        energies = self._move_energies.get((id(move.component), move.from_label, move.to_label))
+        if energies is not None and energies[0] is not move.component:
+            energies = None
+        self._move_energies = dict()
+        self._update_cluster_energies(move, state, None if energies is None else energies[1])
+
+    def batch_target_eval(self, state, moves, context):
+        """Delta log target of all candidate moves of a flip in one go.
+        The energies of the current clusters are cached. The source cluster
+        without the component is scored once, and the clusters after every
+        move are scored together from word counts by
+        _batch_cluster_energies(). Their energies are kept for apply_move()
+        of the selected move."""
+        clusters = []
+        cluster_index = dict()
+
+        def index_of(key, cluster):
+            if key not in cluster_index:
+                cluster_index[key] = len(clusters)
+                clusters.append(cluster)
+            return cluster_index[key]
+
+        num_clusters = len(state)
+        terms = []
+        for move in moves:
+            if move.from_label == move.to_label:
+                terms.append(None)
+                continue
+            source = state.members(move.from_label)
+            new_num_clusters = num_clusters
+            after = dict()
+            minus = float(self._cluster_energies[move.from_label])
+            if len(source) > len(move.component):
+                after[move.from_label] = index_of(('without', move.from_label, id(move.component)), source - move.component)
+            else:
+                new_num_clusters -= 1
+            if move.to_label in state:
+                target = state.members(move.to_label)
+                minus += float(self._cluster_energies[move.to_label])
+                after[move.to_label] = index_of(('with', move.to_label, id(move.component)), target | move.component)
+            else:
+                after[move.to_label] = index_of(('new', id(move.component)), move.component)
+                new_num_clusters += 1
+            terms.append((after, minus, new_num_clusters))
+
+        energies = self._batch_cluster_energies(clusters)
+        temperature = self._current_temperature(context)
+        deltas = np.zeros(len(moves))
+        self._move_energies = dict()
+        for i, term in enumerate(terms):
+            if term is None:
+                continue
+            (after, minus, new_num_clusters) = term
+            after_energies = dict((label, float(energies[index])) for (label, index) in after.items())
+            move = moves[i]
+            self._move_energies[(id(move.component), move.from_label, move.to_label)] = (move.component, after_energies)
+            delta = sum(after_energies.values()) - minus
+            delta += float(self.num_clusters_energy(new_num_clusters) - self.num_clusters_energy(num_clusters))
+            deltas[i] = -delta / temperature
+        return deltas
+
+    def _batch_cluster_energies(self, clusters):
+        """cluster_energy() of several clusters as an array. The word counts
+        of all clusters are summed by one sparse product per word type."""
+        if self._vertex_word_counts is None:
+            self._vertex_word_counts = self._build_vertex_word_counts()
+        rows = np.repeat(np.arange(len(clusters)), [len(cluster) for cluster in clusters])
+        columns = np.fromiter((v for cluster in clusters for v in cluster), dtype=np.int64, count=len(rows))
+        indicator = csr_matrix((np.ones(len(rows)), (rows, columns)), shape=(len(clusters), self.graph_size))
+
+        weights = np.asarray(self.likelihood_weights, dtype=np.float64)
+        likelihood = np.zeros(len(clusters))
+        for word_type in WORD_TYPES:
+            counts = indicator.dot(self._vertex_word_counts[word_type])
+            likelihood += weights[word_type] * probability.count_log_likelihoods(counts, self.likelihood_smoothing)
+        energies = -likelihood / np.sum(weights)
+
+        # prior on time (for level 1 only)
+        if self.level == 1:
+            energies += np.array([float(-mpmath.log(self._time_prior(cluster))) for cluster in clusters])
+        return energies
+
+    def _build_vertex_word_counts(self):
+        """Sparse matrices of word counts, one row per vertex, by word type."""
+        vertex_word_counts = dict()
+        for word_type in WORD_TYPES:
+            indptr = [0]
+            indices = []
+            data = []
+            for vertex_distribution in self.vertex_distributions:
+                (word_ids, counts) = vertex_distribution[word_type].support(counts=True)
+                indices.append(word_ids)
+                data.append(np.rint(counts))
+                indptr.append(indptr[-1] + len(word_ids))
+            vocabulary_size = len(vertex_distribution[word_type])
+            vertex_word_counts[word_type] = csr_matrix(
+                (np.concatenate(data), np.concatenate(indices), indptr), shape=(self.graph_size, vocabulary_size))
+        return vertex_word_counts
+
+    def _log_likelihood(self, clustering, new_vertex_distribution, weights=None):
+        """Weighted average over word types of the log-likelihood of the words
+        of every cluster under its distribution. The words of a cluster are
+        the summed counts of its distribution, so that each word type costs
+        one vector product. 'weights' default to likelihood_weights."""
+        if weights is None:
+            weights = self.likelihood_weights
+        weights = np.asarray(weights, dtype=np.float64)
         likelihood = 0.0
         for i, cluster in enumerate(clustering):
             # Cache the likelihood of cluster to reduce duplicate computation.
-            current_cluster_likelihood = 0.0
+            # The cache holds the likelihoods of the word types, so that the
+            # weights may change between calls.
             if new_vertex_distribution[i] in self._likelihood_cache:
-                current_cluster_likelihood = self._likelihood_cache[new_vertex_distribution[i]]
+                type_likelihoods = self._likelihood_cache[new_vertex_distribution[i]]
             else:
-                for doc in new_vertex_distribution[i].document_ids:
-                    for word_type in WORD_TYPES:
-                        for word_id in self.documents[doc].word_ids[word_type]:
-                            current_cluster_likelihood += weights[word_type] * mpmath.log(new_vertex_distribution[i][word_type][word_id] + 1e-100)
-                self._likelihood_cache[new_vertex_distribution[i]] = current_cluster_likelihood
-            likelihood += current_cluster_likelihood
-        likelihood /= sum(weights)
+                type_likelihoods = np.zeros(NUM_WORD_TYPE)
+                for word_type in WORD_TYPES:
+                    distribution = new_vertex_distribution[i][word_type]
+                    (word_ids, counts) = distribution.support(counts=True)
+                    type_likelihoods[word_type] = distribution.log_likelihood(word_ids, counts, self.likelihood_smoothing)
+                self._likelihood_cache[new_vertex_distribution[i]] = type_likelihoods
+            likelihood += np.dot(weights, type_likelihoods)
+        likelihood /= np.sum(weights)
         #logging.debug('Likelihood {0}'.format(likelihood))
         return likelihood
 
@@ -221,11 +428,24 @@ class SWConfig(object):
             temperature = 0.1
         return temperature
 
+    def make_cooling_schedule(self):
+        """The cooling schedule for sw.sample(). 'linear' keeps cooling_schedule()."""
+        options = dict(start=1000)
+        if self.cooling == 'linear':
+            options.update(period=5, step=5)
+        options.update(self.cooling_options)
+        return cooling.make_schedule(self.cooling, **options)
+
 
 class SWConfigLevel2(SWConfig):
     """SWConfig for level 2."""
-    def __init__(self, graph_size, vertex_distributions, documents, vocabularies, level, classifier):
-        super(SWConfigLevel2, self).__init__(graph_size, vertex_distributions, documents, vocabularies, level)
+    # The inter-cluster similarity and the number of categories do not
+    # decompose over clusters, so level 2 keeps the full evaluation.
+    delta_log_target = None
+    batch_target_eval = None
+
+    def __init__(self, graph_size, vertex_distributions, documents, vocabularies, level, classifier, cooling='linear', cooling_options=None, graph='all_pairs', graph_options=None):
+        super(SWConfigLevel2, self).__init__(graph_size, vertex_distributions, documents, vocabularies, level, cooling, cooling_options, graph, graph_options)
         self._similarity_cache = dict()
         self._within_similarity_cache = dict()
         self._between_similarity_cache = dict()
@@ -420,11 +640,25 @@ def _combine_vertex_distributions_given_clustering(current_vertex_distributions,
 
 
 class TopicModel(object):
-    def __init__(self, classifier_model_filename=None):
+    def __init__(self, classifier_model_filename=None, checkpoint_dir=None, cooling='linear', cooling_options=None, split_merge_ratio=0.0, graph='all_pairs', graph_options=None):
+        """If checkpoint_dir is given, the SW-Cuts run of every level is
+        checkpointed there, and a killed run resumes each level from its
+        last checkpoint on the same inputs. The checkpoints are removed once
+        all levels are done. 'cooling' and 'cooling_options' select the cooling
+        schedule of every level (see SWConfig). 'split_merge_ratio' is the
+        fraction of iterations making split-merge proposals scored by the
+        symmetric KL divergence between vertexes. 'graph' and 'graph_options'
+        select the construction of the level-1 graph (see SWConfig)."""
         self._has_initalized = False
         self.corpus = _Corpus()
         self.topic_tree = _Tree()
         self._classifier_model_file = classifier_model_filename
+        self._checkpoint_dir = checkpoint_dir
+        self._cooling = cooling
+        self._cooling_options = cooling_options
+        self._split_merge_ratio = split_merge_ratio
+        self._graph = graph
+        self._graph_options = graph_options
         pass
 
     def feed(self, original_documents, need_segmentation=False):
@@ -493,6 +727,7 @@ class TopicModel(object):
         current_vertex_distributions = []
         # Initial clustering treat all vertex in the same cluster.
         current_clustering = [set(range(0, len(self.corpus)))]
+        checkpoint_filenames = []
 
         while need_next_level:
             level_counter += 1
@@ -516,14 +751,26 @@ class TopicModel(object):
             #    current_clustering = ground_truth
             #else:
                 # Clustering by SW.
+            checkpoint_filename = self._checkpoint_filename(level_counter, config)
+            if checkpoint_filename is not None:
+                checkpoint_filenames.append(checkpoint_filename)
             current_clustering = sw.sample(
                 config.graph_size,
                 config.edges,
-                config.edge_prob_func,
-                config.target_eval_func,
+                config.edge_probs(),
+                config.log_target_eval_func,
                 intermediate_callback=plotter.plot_callback,
                 initial_clustering=None,
-                monitor_statistics=config.monitor_statistics)
+                monitor_statistics=config.sampler_energy,
+                log_target=True,
+                log_edge_off_func=config.log_edge_off_func,
+                model=config,
+                checkpoint_file=checkpoint_filename,
+                resume=True,
+                static_edge_probs=True,
+                cooling_schedule=config.make_cooling_schedule(),
+                split_merge_ratio=self._split_merge_ratio,
+                split_merge_distance_func=config.vertex_distances)
             current_vertex_distributions = config.vertex_distributions
 
             # Save current clustering as a new level to the tree.
@@ -539,6 +786,31 @@ class TopicModel(object):
             if level_counter >= 2:
                 need_next_level = False
 
+        # The run is complete; a later feed() shall start over.
+        for checkpoint_filename in checkpoint_filenames:
+            if os.path.exists(checkpoint_filename):
+                os.remove(checkpoint_filename)
+
+    def _checkpoint_filename(self, level_counter, config):
+        """Checkpoint of the SW-Cuts run of a level. The name is keyed to the
+        inputs of the level, the graph size, the documents of every vertex
+        and the words of the corpus, and to the cooling, graph and
+        split-merge options, so that only the same run is resumed."""
+        if self._checkpoint_dir is None:
+            return None
+        digest = hashlib.sha1(str(config.graph_size).encode('utf-8'))
+        options = [config.cooling, config.cooling_options, config.graph, config.graph_options, self._split_merge_ratio]
+        digest.update(json.dumps(options, sort_keys=True, default=repr).encode('utf-8'))
+        for vertex_distribution in config.vertex_distributions:
+            digest.update(np.asarray(vertex_distribution.document_ids, dtype=np.int64).tobytes())
+            digest.update(b'|')
+        for document in self.corpus:
+            digest.update(document.name.encode('utf-8'))
+            for word_type in WORD_TYPES:
+                digest.update(np.asarray(document.word_ids[word_type], dtype=np.int64).tobytes())
+                digest.update(b'|')
+        return os.path.join(self._checkpoint_dir, 'sw_level_{0}_{1}.npz'.format(level_counter, digest.hexdigest()[0:16]))
+
     def _generate_initial_vertex_distributions(self):
         # WARINING: generating vertex distribution with ocr_included will
         # cause ocr words to be added to main word lists.
@@ -570,12 +842,12 @@ class TopicModel(object):
                 current_vertex_distributions, current_clustering)
 
         if level_counter == 1:
-            config = SWConfig(graph_size, vertex_distributions=next_vertex_distributions, documents=self.corpus.documents, vocabularies=self.corpus.vocabularies, level=level_counter)
+            config = SWConfig(graph_size, vertex_distributions=next_vertex_distributions, documents=self.corpus.documents, vocabularies=self.corpus.vocabularies, level=level_counter, cooling=self._cooling, cooling_options=self._cooling_options, graph=self._graph, graph_options=self._graph_options)
         elif level_counter == 2:
             classifier = None
             if self._classifier_model_file is not None:
                 classifier = Classifier(self._classifier_model_file)
-            config = SWConfigLevel2(graph_size, vertex_distributions=next_vertex_distributions, documents=self.corpus.documents, vocabularies=self.corpus.vocabularies, level=level_counter, classifier=classifier)
+            config = SWConfigLevel2(graph_size, vertex_distributions=next_vertex_distributions, documents=self.corpus.documents, vocabularies=self.corpus.vocabularies, level=level_counter, classifier=classifier, cooling=self._cooling, cooling_options=self._cooling_options)
         config.setup()
         return config
 
@@ -624,12 +896,16 @@ class _TreeNode(object):
         else:
             return self._children[0].level() + 1
 
-    def log_likelihood(self, document):
-        log_likelihood = mpmath.mpf(0.0)
+    def log_likelihood(self, document, smoothing=1e-100):
+        """Log-likelihood of the words of the document, from their counts.
+        Words out of the vocabulary of the node are skipped."""
+        log_likelihood = 0.0
         for word_type in WORD_TYPES:
-            for word_id in document.word_ids[word_type]:
-                if word_id in self._vertex_distribution[word_type]:
-                    log_likelihood += mpmath.log(self._vertex_distribution[word_type][word_id] + 1e-100)
+            distribution = self._vertex_distribution[word_type]
+            word_ids = np.asarray(document.word_ids[word_type], dtype=np.int64)
+            word_ids = word_ids[(word_ids >= 0) & (word_ids < len(distribution))]
+            (word_ids, counts) = np.unique(word_ids, return_counts=True)
+            log_likelihood += distribution.log_likelihood(word_ids, counts, smoothing)
         return log_likelihood
 
     def add_child(self, node):
@@ -829,22 +1105,22 @@ class _Corpus(object):
         return self.documents[document_id]
 
     def get_dococument_distribution(self, doc_id, word_type, include_ocr=False):
-        histogram = np.zeros(self.vocabulary_size(word_type))
-        for word_id in self.documents[doc_id].word_ids[word_type]:
-            histogram[word_id] += 1
+        """SparseDistribution of the words of the document, over the vocabulary
+        of 'word_type'."""
+        word_ids = list(self.documents[doc_id].word_ids[word_type])
         # Include OCR.
         if include_ocr:
             for ocr_word in self.documents[doc_id].ocr_words:
                 if ocr_word in self.vocabularies[word_type]:
                     ocr_word_id = self.vocabularies[word_type].get_word_index(ocr_word)
-                    histogram[ocr_word_id] += 1
+                    word_ids.append(ocr_word_id)
                     # WARINING / FIXME:
                     # Here the document content is extended by ocr words.
                     # If this method is called multiple times, ocr words
                     # will be added to the document redundantly.
                     self.documents[doc_id].word_ids[word_type].append(ocr_word_id)
 
-        return Distribution(histogram)
+        return SparseDistribution(word_ids, length=self.vocabulary_size(word_type))
 
     def add_document(self, original_doc):
         """Convert the document to feature and save into document list.
@@ -1,88 +1,284 @@
-# The whole SW Process
+# Headless benchmark suite of the SW sampler.
+#
+# Usage:
+#     python potts.py [--workloads lattice-32 chain-500 ...] [--iterations N] [--output report.json]
+#
+# Every workload samples a weighted Potts model
+#     log target = beta * sum(w_e for agreeing edges e) - label_penalty * number of clusters
+# with static edge probabilities q_e = 1 - exp(-beta * max(w_e, 0)), on
+#     lattice-N:  N x N lattice with unit couplings, starting from stripes.
+#     chain-N:    chain of N nodes like the segmentation setup of sw_process.py,
+#                 with noisy couplings around hidden segments, starting from
+#                 singletons and flipping a fifth of the components per iteration.
+#     knn-N:      random k-nearest-neighbor graph of N points drawn from blobs,
+#                 sampled like the chains.
+# Each workload runs in a fresh process with a fixed seed, and reports
+# iterations/sec, the time until the statistic of the workload reaches its
+# target and the peak resident set size as JSON.
 from algorithm import sw
-import math
 
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import sys
+import time
 
-N = 64
+import numpy as np
+import scipy
+from scipy.spatial import cKDTree
 
-edges = []
-for i in range(0, N):
-    for j in range(0, N):
-        current_v = i * N + j
-        assert(current_v < N*N)
-        if j < (N-1):
-            right_v = i * N + j + 1
-            assert(right_v < N*N)
-            edges.append((current_v, right_v))
 
-        if i < (N-1):
-            down_v = (i+1) * N + j
-            assert(down_v < N*N)
-            edges.append((current_v, down_v))
+WORKLOADS = (
+    'lattice-32', 'lattice-64', 'lattice-128', 'lattice-256',
+    'chain-500', 'chain-5000',
+    'knn-2000', 'knn-20000')
 
 
-class Model(object):
-    def __init__(self):
-        beta = 0.5
-        self.prob_on = 1.0 - math.exp(-beta)
+class PottsModel(sw.IncrementalModel):
+    """Weighted Potts model scored incrementally: a move of component C from
+    cluster a to cluster b changes the agreeing weight by w(C, b) - w(C, a - C)."""
+    def __init__(self, graph_size, edges, weights, beta=1.0, label_penalty=0.0):
+        super(PottsModel, self).__init__()
+        self.beta = beta
+        self.label_penalty = label_penalty
+        edges = np.asarray(edges, dtype=np.int64).reshape(-1, 2)
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.sources = edges[:, 0]
+        self.targets = edges[:, 1]
+
+        # Adjacency in CSR form, both directions of every edge.
+        ends = np.concatenate([self.sources, self.targets])
+        others = np.concatenate([self.targets, self.sources])
+        order = np.argsort(ends, kind='stable')
+        self._indptr = np.concatenate([[0], np.cumsum(np.bincount(ends, minlength=graph_size))])
+        self._neighbors = others[order]
+        self._neighbor_weights = np.concatenate([self.weights, self.weights])[order]
+        self._in_component = np.zeros(graph_size, dtype=bool)
+        self._cached_component = None
+        self._cached_cut = None
+
+    def edge_probs(self):
+        return -np.expm1(-self.beta * np.maximum(self.weights, 0.0))
+
+    def log_target(self, state, context):
+        labels = state.labels
+        agreeing = labels[self.sources] == labels[self.targets]
+        return self.beta * float(self.weights[agreeing].sum()) - self.label_penalty * len(state)
+
+    def _cut_weights(self, component, labels):
+        """Weight between the component and every other cluster, by label."""
+        if self._cached_component is not component:
+            vertices = np.fromiter(component, dtype=np.int64, count=len(component))
+            starts = self._indptr[vertices]
+            counts = self._indptr[vertices + 1] - starts
+            offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+            neighbors = self._neighbors[offsets]
+            self._in_component[vertices] = True
+            outside = ~self._in_component[neighbors]
+            self._in_component[vertices] = False
+            neighbor_labels, inverse = np.unique(labels[neighbors[outside]], return_inverse=True)
+            sums = np.bincount(inverse, weights=self._neighbor_weights[offsets][outside], minlength=len(neighbor_labels))
+            self._cached_cut = dict(zip(neighbor_labels.tolist(), sums.tolist()))
+            self._cached_component = component
+        return self._cached_cut
+
+    def reset(self, state, context):
+        self._cached_component = None
+
+    def delta_log_target(self, move, state, context):
+        if move.from_label == move.to_label:
+            return 0.0
+        cut = self._cut_weights(move.component, state.labels)
+        delta = self.beta * (cut.get(move.to_label, 0.0) - cut.get(move.from_label, 0.0))
+        if move.to_label not in state:
+            delta -= self.label_penalty
+        elif len(state.members(move.from_label)) == len(move.component):
+            delta += self.label_penalty
+        return delta
+
+    def apply_move(self, move, state, context):
+        self._cached_component = None
+
+    def revert_move(self, move, state, context):
+        self._cached_component = None
+
+
+class TargetProbe(object):
+    """Stop criterion which never stops the sampling, but records when the
+    statistic of the workload first reaches its target. The time spent on
+    the statistic itself is kept apart."""
+    def __init__(self, statistic, target, interval):
+        self._statistic = statistic
+        self._target = target
+        self._interval = interval
+        self.start_time = time.perf_counter()
+        self.probe_time = 0.0
+        self.value = None
+        self.reached_iteration = None
+        self.reached_time = None
+
+    def update(self, context):
+        if self.reached_iteration is None and context.iteration_counter % self._interval == 0:
+            start = time.perf_counter()
+            self.value = self._statistic(context.current_labels)
+            self.probe_time += time.perf_counter() - start
+            if self.value <= self._target:
+                self.reached_iteration = context.iteration_counter
+                self.reached_time = time.perf_counter() - self.start_time - self.probe_time
+        return False
+
+    def get_state(self):
+        return {}
+
+    def set_state(self, state):
         pass
 
-    def edge_prob(self, s, t, context):
-        return self.prob_on * (context.current_labeling[s] == context.current_labeling[t])
 
-    def target_prob(self, labeling):
-        # uniform
-        return 1.0
+def _lattice(n, rng):
+    index = np.arange(n * n).reshape(n, n)
+    edges = np.concatenate([
+        np.stack([index[:, :-1].ravel(), index[:, 1:].ravel()], axis=1),
+        np.stack([index[:-1, :].ravel(), index[1:, :].ravel()], axis=1)])
+    weights = np.ones(len(edges))
+    # Vertical stripes of two labels, as in the original Potts setup.
+    initial_clustering = [set(index[:, 0::2].ravel().tolist()), set(index[:, 1::2].ravel().tolist())]
+
+    def statistic(labels):
+        # Fraction of edges between different clusters.
+        return float(np.mean(labels[edges[:, 0]] != labels[edges[:, 1]]))
+    return dict(graph_size=n * n, edges=edges, weights=weights, beta=1.5, label_penalty=2.0,
+                initial_clustering=initial_clustering, sweep=None, statistic=statistic, target=0.1)
+
+
+def _truth_statistic(edges, truth):
+    same = truth[edges[:, 0]] == truth[edges[:, 1]]
+
+    def statistic(labels):
+        # Fraction of edges on which the clustering disagrees with the truth.
+        return float(np.mean((labels[edges[:, 0]] == labels[edges[:, 1]]) != same))
+    return statistic
+
 
-    def statistics(self, labeling):
-        h = 0.0
-        for (s, t) in edges:
-            if (labeling[s] != labeling[t]):
-                h += 1
-        h = h / (2*N*N)
-        return h
+def _chain(n, rng):
+    # Segments of 5 to 40 nodes, like stories in a transcript.
+    lengths = rng.integers(5, 41, size=n)
+    truth = np.repeat(np.arange(n), lengths)[:n]
+    edges = np.stack([np.arange(n - 1), np.arange(1, n)], axis=1)
+    same = truth[:-1] == truth[1:]
+    weights = np.where(same, 1.0, -1.0) + rng.normal(0.0, 0.3, size=n - 1)
+    initial_clustering = [{i} for i in range(n)]
+    return dict(graph_size=n, edges=edges, weights=weights, beta=3.0, label_penalty=1.0,
+                initial_clustering=initial_clustering, sweep=0.2, statistic=_truth_statistic(edges, truth), target=0.1)
 
 
-class Plotter(object):
-    def __init__(self, model):
-        self.iterations = []
-        self.energies = []
-        self.model = model
+def _knn(n, rng, k=10, num_blobs=20, dimension=8):
+    centers = rng.normal(0.0, 4.0, size=(num_blobs, dimension))
+    truth = rng.integers(0, num_blobs, size=n)
+    points = centers[truth] + rng.normal(0.0, 1.0, size=(n, dimension))
+    distances, neighbors = cKDTree(points).query(points, k=k + 1)
+    pairs = np.stack([np.repeat(np.arange(n), k), neighbors[:, 1:].ravel()], axis=1)
+    pairs.sort(axis=1)
+    edges, first = np.unique(pairs, axis=0, return_index=True)
+    scale = np.median(distances[:, 1:])
+    weights = 2.0 * np.exp(-(distances[:, 1:].ravel()[first] / scale) ** 2) - 0.5
+    initial_clustering = [{i} for i in range(n)]
+    return dict(graph_size=n, edges=edges, weights=weights, beta=2.0, label_penalty=1.0,
+                initial_clustering=initial_clustering, sweep=0.2, statistic=_truth_statistic(edges, truth), target=0.4)
 
-        # You probably won't need this if you're embedding things in a tkinter plot...
-        plt.ion()
-        self.fig = plt.figure()
-        self.energy_plot = self.fig.add_subplot(111)
 
-    def plot_callback(self, current_labeling, context):
-        print(current_labeling)
+def make_workload(name, seed=0):
+    kind, size = name.split('-')
+    rng = np.random.default_rng(seed)
+    builders = {'lattice': _lattice, 'chain': _chain, 'knn': _knn}
+    if kind not in builders:
+        raise ValueError('Unknown workload: {0}'.format(name))
+    return builders[kind](int(size), rng)
 
-        self.iterations.append(context.iteration_counter)
-        self.energies.append(self.model.statistics(current_labeling))
 
-        self.energy_plot.clear()
-        self.energy_plot.plot(self.iterations, self.energies)
-        self.fig.canvas.draw()
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS.
+    return peak if sys.platform == 'darwin' else peak * 1024
 
 
-def SW_Process():
-    node_number = N*N
+def run_workload(name, iterations, seed=0, probe_interval=10):
+    setup_start = time.perf_counter()
+    workload = make_workload(name, seed)
+    model = PottsModel(workload['graph_size'], workload['edges'], workload['weights'],
+                       workload['beta'], workload['label_penalty'])
+    edges = [tuple(e) for e in workload['edges'].tolist()]
+    setup_time = time.perf_counter() - setup_start
 
-    model = Model()
-    plotter = Plotter(model)
+    probe = TargetProbe(workload['statistic'], workload['target'], probe_interval)
+    start = time.perf_counter()
+    clustering = sw.sample(
+        workload['graph_size'], edges, model.edge_probs(), None,
+        initial_clustering=workload['initial_clustering'], seed=seed, log_target=True, model=model,
+        stop_criteria=[probe, sw.IterationBudget(iterations)], sweep=workload['sweep'], static_edge_probs=True)
+    elapsed = time.perf_counter() - start - probe.probe_time
 
-    initial_labeling = []
-    for i in range(0, node_number):
-        initial_labeling.append(i % 2)
-    #initial_labeling = None
+    return {
+        'workload': name,
+        'vertices': workload['graph_size'],
+        'edges': len(edges),
+        'iterations': iterations,
+        'seed': seed,
+        'sweep': workload['sweep'],
+        'setup_seconds': setup_time,
+        'sampling_seconds': elapsed,
+        'iterations_per_second': iterations / elapsed if elapsed > 0 else None,
+        'target_statistic': workload['target'],
+        'final_statistic': workload['statistic'](_labels_of(clustering, workload['graph_size'])),
+        'iterations_to_target': probe.reached_iteration,
+        'seconds_to_target': probe.reached_time,
+        'num_clusters': len(clustering),
+        'peak_rss_bytes': _peak_rss_bytes()}
 
-    print('Start Sampling')
-    sw.sample(node_number, edges, model.edge_prob, model.target_prob, plotter.plot_callback, initial_labeling=initial_labeling, max_labels=2)
+
+def _labels_of(clustering, size):
+    labels = np.empty(size, dtype=np.int64)
+    for label, cluster in enumerate(clustering):
+        labels[list(cluster)] = label
+    return labels
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': multiprocessing.cpu_count()}
 
 
 def main():
-    SW_Process()
+    parser = argparse.ArgumentParser(description='Benchmark the SW sampler on Potts models.')
+    parser.add_argument('--workloads', nargs='+', default=list(WORKLOADS),
+                        help='workloads to run, e.g. lattice-64 chain-500 knn-2000')
+    parser.add_argument('--iterations', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the report to, stdout by default')
+    args = parser.parse_args()
+
+    results = []
+    for name in args.workloads:
+        # A fresh process per workload, so that the peak RSS is its own.
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            result = executor.submit(run_workload, name, args.iterations, args.seed).result()
+        print('{workload}: {iterations_per_second:.1f} it/s, target reached at iteration {iterations_to_target}'.format(**result),
+              file=sys.stderr)
+        results.append(result)
+
+    report = json.dumps({'environment': environment(), 'results': results}, indent=2)
+    if args.output is None:
+        print(report)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
 
 
 if __name__ == '__main__':
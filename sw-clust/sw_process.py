@@ -35,7 +35,7 @@ class Plotter(object):
 
         self.iterations.append(context.iteration_counter)
         self.energies.append(self.segmentation_model.calculate_energy(current_labeling))
-        self.temperatures.append(self.segmentation_model.cooling_schedule(context.iteration_counter))
+        self.temperatures.append(self.segmentation_model._current_temperature(context))
 
         # energy plot
         self.energy_plot.clear()
@@ -82,7 +82,7 @@ def sw_Process():
         edges.append([i, j])
 
     print('Start Sampling')
-    sw.sample(node_number, edges, segmentation_model.calculate_Qe, segmentation_model.target_evaluation_func, plotter.plot_callback, initial_clustering=None, monitor_statistics=segmentation_model.calculate_energy)
+    sw.sample(node_number, edges, segmentation_model.calculate_Qe, segmentation_model.log_target_evaluation_func, plotter.plot_callback, initial_clustering=None, monitor_statistics=segmentation_model.calculate_energy, log_target=True, model=segmentation_model, static_edge_probs=True, cooling_schedule=segmentation_model.make_cooling_schedule())
     print('Converged.')
     plotter.save()
 